@@ -3,48 +3,274 @@
 # load_dotenv()
 
 #Step1: Setup API Keys for Groq, OpenAI and Tavily
+import time
+_module_import_started=time.perf_counter()
+
 import os
+import asyncio
+import hashlib
+import importlib
+import json
+import sys
+import threading
+
+from cache import LRUCache
+from metrics import counter, gauge, histogram, time_stage
+from profiling import record_span
 
 GROQ_API_KEY=os.environ.get("GROQ_API_KEY")
 TAVILY_API_KEY=os.environ.get("TAVILY_API_KEY")
 OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY")
 
 #Step2: Setup LLM & Tools
-from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
-from langchain_community.tools.tavily_search import TavilySearchResults
+# Provider packages are heavy, so they are imported the first time a provider is used
+# rather than at startup; only the provider actually requested needs its API key.
 from langchain_core.messages import SystemMessage, HumanMessage
 
-openai_llm=ChatOpenAI(model="gpt-4o-mini")
-groq_llm=ChatGroq(model="llama-3.3-70b-versatile")
+# Provider name -> (module, chat model class)
+PROVIDERS={
+    "Groq": ("langchain_groq", "ChatGroq"),
+    "OpenAI": ("langchain_openai", "ChatOpenAI"),
+}
+
+_lazy_import_seconds={}
+_lazy_import_lock=threading.Lock()
 
-search_tool=TavilySearchResults(max_results=2)
+def _lazy_import(module_name, attr):
+    """Import module_name on first use (timing it) and return one of its attributes"""
+    module=sys.modules.get(module_name)
+    if module is None:
+        with _lazy_import_lock:
+            module=sys.modules.get(module_name)
+            if module is None:
+                started=time.perf_counter()
+                module=importlib.import_module(module_name)
+                _lazy_import_seconds[module_name]=round(time.perf_counter()-started, 4)
+    return getattr(module, attr)
+
+def get_import_report():
+    """Get import timings: this module's own import and each lazily imported package"""
+    return {
+        "module_import_seconds": _module_import_seconds,
+        "lazy_imports": dict(_lazy_import_seconds),
+        "loaded_providers": [name for name, (module_name, _) in PROVIDERS.items() if module_name in sys.modules]
+    }
 
 #Step3: Setup AI Agent with Search tool functionality
-from langgraph.prebuilt import create_react_agent
-from langchain_core.messages.ai import AIMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages.ai import AIMessage, AIMessageChunk
+from langchain_core.messages.tool import ToolMessage
 
 system_prompt="Act as an AI chatbot who is smart and friendly"
 
-def get_response_from_ai_agent(llm_id, query, allow_search, system_prompt, provider):
-    if provider=="Groq":
-        llm=ChatGroq(model=llm_id)
-    elif provider=="OpenAI":
-        llm=ChatOpenAI(model=llm_id)
-
-    tools=[TavilySearchResults(max_results=2)] if allow_search else []
-    agent=create_react_agent(
-        model=llm,
-        tools=tools
-    )
-    
+# Maximum number of agent runs in flight at once per worker (override via environment)
+AGENT_MAX_CONCURRENCY=int(os.environ.get("AGENT_MAX_CONCURRENCY", "32"))
+_agent_semaphore=asyncio.Semaphore(AGENT_MAX_CONCURRENCY)
+
+# Compiled agents and LLM clients are reused across requests (override sizes via environment)
+AGENT_CACHE_SIZE=int(os.environ.get("AGENT_CACHE_SIZE", "16"))
+_llm_cache=LRUCache(maxsize=AGENT_CACHE_SIZE)
+_agent_cache=LRUCache(maxsize=AGENT_CACHE_SIZE)
+
+def _build_llm(llm_id, provider):
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown model provider: {provider}")
+    module_name, class_name=PROVIDERS[provider]
+    return _lazy_import(module_name, class_name)(model=llm_id)
+
+def _build_agent(llm_id, allow_search, provider):
+    with time_stage("agent_build"):
+        llm=_llm_cache.get_or_create((provider, llm_id), lambda: _build_llm(llm_id, provider))
+        if allow_search:
+            TavilySearchResults=_lazy_import("langchain_community.tools.tavily_search", "TavilySearchResults")
+            tools=[TavilySearchResults(max_results=2)]
+        else:
+            tools=[]
+        create_react_agent=_lazy_import("langgraph.prebuilt", "create_react_agent")
+        return create_react_agent(
+            model=llm,
+            tools=tools
+        )
+
+def get_agent(llm_id, allow_search, provider):
+    """Get a compiled ReAct agent, building it only on first use"""
+    key=(provider, llm_id, bool(allow_search))
+    return _agent_cache.get_or_create(key, lambda: _build_agent(llm_id, allow_search, provider))
+
+async def aget_agent(llm_id, allow_search, provider):
+    """get_agent for the async paths: a cache miss (provider import and graph compile) runs in a worker thread"""
+    if (provider, llm_id, bool(allow_search)) in _agent_cache:
+        return get_agent(llm_id, allow_search, provider)
+    return await asyncio.to_thread(get_agent, llm_id, allow_search, provider)
+
+def get_agent_cache_stats():
+    """Get hit/miss/eviction counters for the agent and LLM client caches"""
+    return {"agents": _agent_cache.stats(), "llm_clients": _llm_cache.stats()}
+
+# Opt-in cache of final replies for identical requests (override via environment)
+RESPONSE_CACHE_ENABLED=os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE=int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL=float(os.environ.get("RESPONSE_CACHE_TTL", "300"))
+_response_cache=LRUCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def _response_cache_key(llm_id, query, allow_search, system_prompt, provider):
+    """Hash everything that determines the reply: model, provider, prompt, context window and search flag"""
+    payload=json.dumps([provider, llm_id, system_prompt, list(query), bool(allow_search)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _response_cache_lookup(llm_id, query, allow_search, system_prompt, provider, use_cache):
+    """Return (key, cached reply); key is None when caching is off or bypassed for this request"""
+    if not (RESPONSE_CACHE_ENABLED and use_cache):
+        return None, None
+    key=_response_cache_key(llm_id, query, allow_search, system_prompt, provider)
+    return key, _response_cache.get(key)
+
+def get_response_cache_stats():
+    """Get hit-rate counters for the response cache"""
+    return {"enabled": RESPONSE_CACHE_ENABLED, **_response_cache.stats()}
+
+# Agent metrics (served by GET /metrics)
+LLM_CALL_DURATION=histogram("llm_call_duration_seconds", "Duration of each model call inside an agent run", ["provider", "model"])
+TOOL_CALL_DURATION=histogram("tool_call_duration_seconds", "Duration of each tool call inside an agent run", ["tool"])
+AGENT_ERRORS=counter("agent_errors_total", "Agent runs that raised an error", ["provider", "model"])
+AGENT_IN_FLIGHT=gauge("agent_runs_in_flight", "Agent runs currently executing")
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Times the model and tool calls of one agent run (metrics, plus spans for profiled requests)"""
+    # Called on the event loop directly; the bookkeeping is too cheap to hand off to a thread
+    run_inline=True
+
+    def __init__(self, provider, llm_id):
+        self.provider=provider
+        self.llm_id=llm_id
+        self._started={}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id]=(time.perf_counter(), None)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id]=(time.perf_counter(), None)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish_llm(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish_llm(run_id, error=repr(error))
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id]=(time.perf_counter(), (serialized or {}).get("name", "unknown"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish_tool(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish_tool(run_id, error=repr(error))
+
+    def _finish_llm(self, run_id, error=None):
+        started=self._started.pop(run_id, None)
+        if started:
+            ended=time.perf_counter()
+            LLM_CALL_DURATION.observe(ended-started[0], provider=self.provider, model=self.llm_id)
+            record_span("llm", started[0], ended, provider=self.provider, model=self.llm_id, error=error)
+
+    def _finish_tool(self, run_id, error=None):
+        started=self._started.pop(run_id, None)
+        if started:
+            ended=time.perf_counter()
+            TOOL_CALL_DURATION.observe(ended-started[0], tool=started[1])
+            record_span("tool", started[0], ended, tool=started[1], error=error)
+
+def _run_config(llm_id, provider):
+    return {"callbacks": [MetricsCallbackHandler(provider, llm_id)]}
+
+# Chat roles -> LangChain message classes
+MESSAGE_TYPES={"system": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+
+def _build_state(query, system_prompt):
+    """query holds {"role", "content"} dicts (see context_builder); plain strings are user messages"""
     # Add system prompt to the beginning of messages
     messages = [SystemMessage(content=system_prompt)]
     for msg in query:
-        messages.append(HumanMessage(content=msg))
-    
-    state={"messages": messages}
-    response=agent.invoke(state)
+        if isinstance(msg, str):
+            messages.append(HumanMessage(content=msg))
+        else:
+            messages.append(MESSAGE_TYPES[msg["role"]](content=msg["content"]))
+    return {"messages": messages}
+
+def _extract_response(response):
     messages=response.get("messages")
     ai_messages=[message.content for message in messages if isinstance(message, AIMessage)]
-    return ai_messages[-1]
\ No newline at end of file
+    return ai_messages[-1]
+
+def get_response_from_ai_agent(llm_id, query, allow_search, system_prompt, provider, use_cache=True):
+    cache_key, cached=_response_cache_lookup(llm_id, query, allow_search, system_prompt, provider, use_cache)
+    if cached is not None:
+        return cached
+    agent=get_agent(llm_id, allow_search, provider)
+    try:
+        with AGENT_IN_FLIGHT.track_inprogress(), time_stage("agent", provider=provider, model=llm_id):
+            response=_extract_response(agent.invoke(_build_state(query, system_prompt), config=_run_config(llm_id, provider)))
+    except Exception:
+        AGENT_ERRORS.inc(provider=provider, model=llm_id)
+        raise
+    if cache_key:
+        _response_cache.set(cache_key, response)
+    return response
+
+async def aget_response_from_ai_agent(llm_id, query, allow_search, system_prompt, provider, use_cache=True):
+    """Async variant for the API: runs the agent without blocking the event loop"""
+    cache_key, cached=_response_cache_lookup(llm_id, query, allow_search, system_prompt, provider, use_cache)
+    if cached is not None:
+        return cached
+    agent=await aget_agent(llm_id, allow_search, provider)
+    try:
+        async with _agent_semaphore:
+            with AGENT_IN_FLIGHT.track_inprogress(), time_stage("agent", provider=provider, model=llm_id):
+                response=await agent.ainvoke(_build_state(query, system_prompt), config=_run_config(llm_id, provider))
+        response=_extract_response(response)
+    except Exception:
+        AGENT_ERRORS.inc(provider=provider, model=llm_id)
+        raise
+    if cache_key:
+        _response_cache.set(cache_key, response)
+    return response
+
+# Yielded by astream_response_from_ai_agent when a tool step starts: the text streamed so far wasn't the final answer
+STREAM_RESET=object()
+
+async def astream_response_from_ai_agent(llm_id, query, allow_search, system_prompt, provider, use_cache=True):
+    """Yield the reply as text chunks while the model generates it.
+
+    Only the final answer is kept: text the model emits before a tool call
+    is followed by STREAM_RESET, telling the consumer to discard it, so the
+    stored reply matches what /chat returns.
+    """
+    cache_key, cached=_response_cache_lookup(llm_id, query, allow_search, system_prompt, provider, use_cache)
+    if cached is not None:
+        # Cached replies arrive as a single chunk
+        yield cached
+        return
+    agent=await aget_agent(llm_id, allow_search, provider)
+    chunks=[]
+    try:
+        async with _agent_semaphore:
+            with AGENT_IN_FLIGHT.track_inprogress(), time_stage("agent", provider=provider, model=llm_id):
+                async for chunk, _ in agent.astream(_build_state(query, system_prompt), config=_run_config(llm_id, provider), stream_mode="messages"):
+                    if isinstance(chunk, ToolMessage) or getattr(chunk, "tool_call_chunks", None):
+                        # A tool step, so anything streamed before it was an intermediate thought
+                        if chunks:
+                            chunks=[]
+                            yield STREAM_RESET
+                        continue
+                    # Only model output; tool results stream through as ToolMessages
+                    if isinstance(chunk, AIMessageChunk) and isinstance(chunk.content, str) and chunk.content:
+                        chunks.append(chunk.content)
+                        yield chunk.content
+    except Exception:
+        AGENT_ERRORS.inc(provider=provider, model=llm_id)
+        raise
+    # Only completed streams are cached
+    if cache_key:
+        _response_cache.set(cache_key, "".join(chunks))
+
+_module_import_seconds=round(time.perf_counter()-_module_import_started, 4)
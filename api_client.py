@@ -0,0 +1,78 @@
+# Shared HTTP client for the Streamlit frontends
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Connection pooling and retry tuning (override via environment)
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", "10"))
+API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", "3"))
+API_BACKOFF_FACTOR = float(os.environ.get("API_BACKOFF_FACTOR", "0.3"))
+
+# (connect, read) timeouts in seconds; chat calls wait on the model, everything else should be quick.
+# For streamed responses the read timeout applies between chunks, not to the whole reply.
+DEFAULT_TIMEOUT = (3.05, 15)
+ENDPOINT_TIMEOUTS: Dict[str, Tuple[float, float]] = {
+    "/chat": (3.05, 120),
+    "/chat/stream": (3.05, 60),
+}
+
+# Gateway errors worth retrying (the backend restarting or a proxy timing out)
+RETRY_STATUSES = (502, 503, 504)
+
+
+class BackendClient:
+    """requests.Session wrapper with keep-alive pooling, per-endpoint timeouts, retries and latency logging.
+
+    Connection failures are retried by the transport (and only there) for
+    every call, since nothing reached the backend. Read timeouts and gateway
+    errors are only retried for calls marked idempotent=True, so a slow /chat
+    is never run twice unless it carries an idempotency key.
+    """
+
+    def __init__(self, base_url: str, pool_size: int = API_POOL_SIZE, max_retries: int = API_MAX_RETRIES,
+                 backoff_factor: float = API_BACKOFF_FACTOR):
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        self.session = requests.Session()
+        connect_retry = Retry(total=max_retries, connect=max_retries, read=0, status=0, other=0,
+                              backoff_factor=backoff_factor, allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=connect_retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, path: str, json: Optional[Dict] = None, idempotent: bool = False, stream: bool = False,
+             timeout: Optional[Tuple[float, float]] = None) -> requests.Response:
+        """POST to a backend endpoint and return the response (raises requests exceptions on failure)"""
+        url = self.base_url + path
+        timeout = timeout or ENDPOINT_TIMEOUTS.get(path, DEFAULT_TIMEOUT)
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(1, attempts + 1):
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, json=json, timeout=timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.warning("POST %s failed after %.0f ms (attempt %d/%d): %s", path,
+                               (time.perf_counter() - started) * 1000, attempt, attempts, e)
+                # Connection failures were already retried by the transport; only read timeouts are retried here
+                if attempt == attempts or not isinstance(e, requests.ReadTimeout):
+                    raise
+            else:
+                logger.info("POST %s -> %d in %.0f ms (attempt %d/%d)", path, response.status_code,
+                            (time.perf_counter() - started) * 1000, attempt, attempts)
+                if response.status_code not in RETRY_STATUSES or attempt == attempts:
+                    return response
+                response.close()
+            time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+
+    def close(self):
+        self.session.close()
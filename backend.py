@@ -8,6 +8,10 @@ from typing import List, Optional
 
 # Import database
 from database import db
+from context_builder import CONTEXT_HISTORY_LIMIT, build_context, estimate_tokens
+from summarizer import summarizer, unsummarized_tokens
+from personalization import conversation_instruction, get_persona_cache_stats, get_persona_prompt
+from profile_learner import learner
 
 class RequestState(BaseModel):
     # User identification and profile
@@ -23,19 +27,174 @@ class RequestState(BaseModel):
 
 
 #Step2: Setup AI Agent from FrontEnd Request
+import asyncio
+import hashlib
+import json
+import os
+import time
 from fastapi import FastAPI, Request
-from ai_agent import get_response_from_ai_agent
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from ai_agent import STREAM_RESET, aget_response_from_ai_agent, astream_response_from_ai_agent, get_agent_cache_stats, get_response_cache_stats, get_import_report
+
+from cache import LRUCache, SingleFlight
+from metrics import REGISTRY, gauge, histogram, time_stage
+from profiling import start_trace
 
 ALLOWED_MODEL_NAMES=["llama3-70b-8192", "mixtral-8x7b-32768", "llama-3.3-70b-versatile", "gpt-4o-mini"]
 
+# Idempotent chat turns: a retry with the same key within the window gets the stored result (override via environment)
+IDEMPOTENCY_TTL=float(os.environ.get("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_CACHE_SIZE=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Idempotency key -> (request fingerprint, result); a key reused for a different request is rejected
+_idempotent_results=LRUCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+# Concurrent identical /chat requests share one agent call
+_chat_flights=SingleFlight()
+# Request fingerprint of each keyed turn in flight
+_flight_fingerprints={}
+# Most missed messages returned with a chat turn before the client is told to resync
+SYNC_MISSED_LIMIT=100
+
+# Request metrics (served by GET /metrics); paths without a route are labeled "other" to bound cardinality
+HTTP_IN_FLIGHT=gauge("http_requests_in_flight", "Requests currently being handled", ["path"])
+HTTP_REQUEST_DURATION=histogram("http_request_duration_seconds", "Time until the response headers are ready", ["method", "path", "status"])
+_route_paths=set()
+
 app=FastAPI(title="LangGraph AI Agent")
 
-@app.post("/chat")
-async def chat_endpoint(request: Request):
-    # Manually parse JSON to avoid automatic validation errors
-    data = await request.json()
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Track in-flight requests and request latency per endpoint.
+
+    For /chat/stream the latency covers preparing the turn; the agent run
+    itself is measured by the "agent" stage and agent_runs_in_flight.
+    """
+    if not _route_paths:
+        _route_paths.update(getattr(route, "path", None) for route in app.routes)
+    path = request.url.path if request.url.path in _route_paths else "other"
+    started = time.perf_counter()
+    status = 500
+    try:
+        with HTTP_IN_FLIGHT.track_inprogress(path=path):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, method=request.method, path=path, status=status)
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """Trace requests that send X-Profile with a valid X-Profile-Token, or are sampled (see profiling.py).
+
+    The trace stays open until the response body has been sent, so streamed
+    turns include the agent run. The response carries the trace id in
+    X-Profile-Id and the span totals so far in Server-Timing; slow and
+    explicitly profiled requests go to the slow-request log.
+    """
+    trace = start_trace(request.method, request.url.path, request.headers.get("X-Profile"),
+                        request.headers.get("X-Profile-Token"))
+    if trace is None:
+        return await call_next(request)
+    
+    try:
+        response = await call_next(request)
+    except Exception:
+        trace.finish(500)
+        raise
+    response.headers["X-Profile-Id"] = trace.id
+    response.headers["Server-Timing"] = trace.server_timing()
+    
+    body = response.body_iterator
+    async def traced_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            trace.finish(response.status_code)
+    
+    response.body_iterator = traced_body()
+    return response
+
+@app.on_event("shutdown")
+def shutdown_database():
+    """Finish queued summaries and learning, then close pooled database connections on shutdown"""
+    summarizer.close()
+    learner.close()
+    db.close()
+
+@app.get("/system/stats")
+async def get_system_stats():
+    """Get runtime statistics (database pool and caches, agent and response caches, import timings)"""
+    return {
+        "db_pool": db.get_pool_stats(),
+        "db_cache": db.get_cache_stats(),
+        "agent_cache": get_agent_cache_stats(),
+        "response_cache": get_response_cache_stats(),
+        "summarizer": summarizer.stats(),
+        "learner": learner.stats(),
+        "persona_cache": get_persona_cache_stats(),
+        "idempotency": {"results": _idempotent_results.stats(), "flights": _chat_flights.stats()},
+        "imports": get_import_report()
+    }
+
+def collect_runtime_metrics():
+    """Pool, cache and background worker stats as Prometheus samples, read at scrape time"""
+    pool = db.get_pool_stats()
+    yield ("db_pool_connections", "gauge", "Pooled database connections by state",
+           [({"state": state}, pool[state]) for state in ("open", "idle", "in_use", "waiting")])
+    yield ("db_pool_waits_total", "counter", "Connection requests that had to wait", [({}, pool["waits"])])
+    yield ("db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection", [({}, pool["wait_time_seconds"])])
+    yield ("db_pool_timeouts_total", "counter", "Connection requests that timed out", [({}, pool["timeouts"])])
+    
+    db_caches = db.get_cache_stats()
+    agent_caches = get_agent_cache_stats()
+    caches = {
+        "db_users": db_caches["users"],
+        "db_personalization": db_caches["personalization"],
+        "agents": agent_caches["agents"],
+        "llm_clients": agent_caches["llm_clients"],
+        "response": get_response_cache_stats(),
+        "persona": get_persona_cache_stats(),
+        "idempotency": _idempotent_results.stats()
+    }
+    yield ("cache_hit_ratio", "gauge", "Hits over lookups for each in-process cache",
+           [({"cache": name}, stats["hit_ratio"]) for name, stats in caches.items()])
+    yield ("cache_hits_total", "counter", "Cache hits", [({"cache": name}, stats["hits"]) for name, stats in caches.items()])
+    yield ("cache_misses_total", "counter", "Cache misses", [({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    yield ("cache_entries", "gauge", "Entries held by each cache", [({"cache": name}, stats["size"]) for name, stats in caches.items()])
+    
+    flights = _chat_flights.stats()
+    yield ("chat_flights_in_flight", "gauge", "Distinct /chat agent calls in flight", [({}, flights["in_flight"])])
+    yield ("chat_flights_coalesced_total", "counter", "/chat requests that joined an identical call in flight", [({}, flights["coalesced"])])
+    
+    summaries = summarizer.stats()
+    learning = learner.stats()
+    yield ("summarizer_pending", "gauge", "Session summaries queued or running", [({}, summaries["pending"])])
+    yield ("summarizer_failures_total", "counter", "Session summaries that failed", [({}, summaries["failures"])])
+    yield ("learner_queued", "gauge", "Learning events waiting to be applied", [({}, learning["queued"])])
+    yield ("learner_dropped_total", "counter", "Learning events dropped because the queue was full", [({}, learning["dropped"])])
+
+REGISTRY.add_collector(collect_runtime_metrics)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics in Prometheus text format: stage and request latency histograms, in-flight gauges,
+    database pool and cache stats, agent errors by provider and model"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+def prepare_chat_turn(data):
+    """Validate a chat request and build the agent context (nothing is stored until the reply arrives).
+
+    With "personalize": true the server runs the whole personalization
+    pipeline: the system prompt is built from the user's profile, so the
+    client doesn't send one, and the user's messages are queued for the
+    background learner, which updates the profile for later turns.
+    """
+    personalize = bool(data.get("personalize"))
+    
     # Check for missing fields
     required_fields = ["user_email", "user_name", "model_name", "model_provider", "system_prompt", "messages", "allow_search"]
+    if personalize:
+        required_fields.remove("system_prompt")
     missing = [f for f in required_fields if f not in data]
     if missing:
         return {"error": f"Missing fields in request: {missing}"}
@@ -46,56 +205,304 @@ async def chat_endpoint(request: Request):
     model_name = data["model_name"]
     messages = data["messages"]
     allow_search = data["allow_search"]
-    system_prompt = data["system_prompt"]
+    system_prompt = data.get("system_prompt", "")
     model_provider = data["model_provider"]
     
     # Validate model
     if model_name not in ALLOWED_MODEL_NAMES:
         return {"error": "Invalid model name. Kindly select a valid AI model"}
     
-    # Get or create user
+    # Get or create user (cached; last_login is written in the background)
     user_id = db.create_or_get_user(user_email, user_name)
     
+    # Get user's personalization (cached in-process, no disk read on the chat path)
+    personalization = db.get_user_personalization(user_id)
+    
+    # Session summary plus the recent history it doesn't cover (trimmed to the model's token budget below)
+    chat_history = []
+    summary_state = {'summary': None, 'summary_through_id': 0}
+    if session_id:
+        with db.unit_of_work(write=False) as uow:
+            summary_state = uow.get_session_summary(session_id)
+            chat_history = uow.get_chat_history(session_id, limit=CONTEXT_HISTORY_LIMIT)
+        chat_history = [msg for msg in chat_history if msg['id'] > summary_state['summary_through_id']]
+    
     # Create new session if not provided
     if not session_id:
         session_id = db.create_chat_session(user_id)
     
-    # Get user's personalization
-    personalization = db.get_user_personalization(user_id)
-    
     # Customize system prompt based on user's preferences
-    if personalization.get('custom_prompt'):
+    instructions = []
+    if personalize:
+        # Learning happens in the background; this turn uses the profile as it stands
+        learner.submit_messages(user_id, messages, len(chat_history))
+        # Memoized per profile version; only the short per-turn instruction varies
+        system_prompt = get_persona_prompt(personalization, user_name)
+        instructions.append(conversation_instruction(bool(chat_history or summary_state['summary'])))
+    elif personalization.get('custom_prompt'):
         system_prompt = personalization['custom_prompt']
     
-    # Add user message to database
-    for msg in messages:
-        db.add_message(session_id, "user", msg)
+    # Prepare messages for AI: summary, newest history that fits the budget (roles kept), then this turn's messages
+    context_messages, context_tokens = build_context(chat_history, messages, model_name, system_prompt,
+                                                     summary=summary_state['summary'], instructions=instructions)
+    
+    return {
+        "user_id": user_id,
+        "session_id": session_id,
+        "model_name": model_name,
+        "model_provider": model_provider,
+        "allow_search": allow_search,
+        "system_prompt": system_prompt,
+        "messages": messages,
+        "context_messages": context_messages,
+        "context_tokens": context_tokens,
+        "unsummarized_tokens": unsummarized_tokens(chat_history, summary_state['summary_through_id'], messages),
+        "since_id": data.get("since_id"),
+        "include_history": bool(data.get("include_history")),
+        # Set cache_bypass to force a fresh reply even when the response cache is on
+        "use_cache": not data.get("cache_bypass", False)
+    }
+
+def finish_chat_turn(turn, response):
+    """Store the turn and build the response body, all in one write transaction.
+
+    The user's messages and the assistant reply are inserted together with
+    executemany. Only messages newer than the client's sync cursor are
+    returned (`messages`), with `cursor` set to the newest id for the next
+    request. This turn's messages are always included; if the client missed
+    more than SYNC_MISSED_LIMIT messages before them, `resync` is set and it
+    should reload the history instead of merging. The full recent history
+    is included only when asked for.
+    """
+    session_id = turn["session_id"]
+    
+    with db.unit_of_work() as uow:
+        # Add this turn's user messages and the AI response to database
+        turn_messages = [("user", msg) for msg in turn["messages"]] + [("assistant", response)]
+        message_ids = uow.add_messages(session_id, turn_messages)
+        
+        # Sync cursor: the client's last known message id, else just before this turn
+        since_id = turn["since_id"] if turn["since_id"] is not None else message_ids[0] - 1
+        
+        # Messages the client missed before this turn (newest first, one extra to detect a gap), then this turn's own
+        missed = [msg for msg in uow.get_chat_history(session_id, limit=SYNC_MISSED_LIMIT + 1, before_id=message_ids[0])
+                  if msg['id'] > since_id]
+        resync = len(missed) > SYNC_MISSED_LIMIT
+        new_messages = missed[-SYNC_MISSED_LIMIT:] + uow.get_chat_history(session_id, limit=len(message_ids),
+                                                                          after_id=message_ids[0] - 1)
+        
+        result = {
+            "response": response,
+            "messages": new_messages,
+            "cursor": new_messages[-1]['id'],
+            "resync": resync,
+            "session_id": session_id,
+            "user_id": turn["user_id"],
+            # Estimated prompt size sent to the model this turn
+            "context_tokens": turn["context_tokens"]
+        }
+        if turn["include_history"]:
+            result["history"] = uow.get_chat_history(session_id, limit=50)
     
-    # Get recent chat history for context (last 20 messages)
-    chat_history = db.get_chat_history(session_id, limit=20)
+    # Fold older turns into the session summary in the background once enough has built up
+    if summarizer.needs_summary(turn["unsummarized_tokens"] + estimate_tokens(response)):
+        summarizer.schedule(session_id, turn["model_name"], turn["model_provider"])
+    return result
+
+def _idempotency_key(request, data):
+    """Client-supplied idempotency key (Idempotency-Key header or idempotency_key field), scoped to the user"""
+    key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    return (data.get("user_email"), str(key)) if key else None
+
+def _chat_fingerprint(data):
+    """Hash of the fields that make two chat requests identical"""
+    fields = ["user_email", "session_id", "model_name", "model_provider", "system_prompt", "messages", "allow_search",
+              "personalize", "include_history", "since_id", "cache_bypass"]
+    payload = json.dumps([data.get(f) for f in fields], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _idempotent_replay(idempotency_key, fingerprint):
+    """The stored result for a keyed retry, a 409 response if the key was used (by a stored
+    or running turn) for a different request, or None to run the turn"""
+    stored = _idempotent_results.get(idempotency_key)
+    if stored is not None and stored[0] == fingerprint:
+        return stored[1]
+    if stored is not None or _flight_fingerprints.get(("key",) + idempotency_key, fingerprint) != fingerprint:
+        return JSONResponse(status_code=409, content={"error": "Idempotency key was already used for a different request"})
+    return None
+
+def _start_keyed_flight(flight_key, fingerprint, factory):
+    """Start (or join) the flight of a keyed turn, recording its request fingerprint while it runs"""
+    async def run():
+        try:
+            return await factory()
+        finally:
+            _flight_fingerprints.pop(flight_key, None)
     
-    # Prepare messages for AI (include history for context)
-    context_messages = []
-    for msg in chat_history[:-len(messages)]:  # Exclude just-added messages
-        context_messages.append(msg['content'])
-    context_messages.extend(messages)  # Add current messages
+    if not _chat_flights.running(flight_key):
+        _flight_fingerprints[flight_key] = fingerprint
+    return _chat_flights.start(flight_key, run)
+
+@app.post("/chat")
+async def chat_endpoint(request: Request):
+    """Run one chat turn.
+
+    With an idempotency key, a retry within IDEMPOTENCY_TTL returns the stored
+    result instead of calling the model and storing the messages again; reusing
+    the key for a different request is rejected with 409. Concurrent identical
+    requests (same key, or same body when there is no key) are coalesced onto
+    a single agent call.
+    """
+    # Manually parse JSON to avoid automatic validation errors
+    data = await request.json()
+    idempotency_key = _idempotency_key(request, data)
+    fingerprint = _chat_fingerprint(data)
+    if idempotency_key:
+        replay = _idempotent_replay(idempotency_key, fingerprint)
+        if replay is not None:
+            return replay
     
-    # Invoke AI agent
-    response = get_response_from_ai_agent(model_name, context_messages, allow_search, system_prompt, model_provider)
+    async def run_turn():
+        # Database work runs in worker threads so a held write lock never stalls the event loop
+        with time_stage("prepare"):
+            turn = await asyncio.to_thread(prepare_chat_turn, data)
+        if "error" in turn:
+            return turn
+        
+        # Invoke AI agent (awaited so other requests keep being served)
+        response = await aget_response_from_ai_agent(turn["model_name"], turn["context_messages"], turn["allow_search"], turn["system_prompt"], turn["model_provider"], use_cache=turn["use_cache"])
+        
+        # Store the reply and return only what this turn added
+        with time_stage("store"):
+            result = await asyncio.to_thread(finish_chat_turn, turn, response)
+        if idempotency_key:
+            _idempotent_results.set(idempotency_key, (fingerprint, result))
+        return result
     
-    # Add AI response to database
-    db.add_message(session_id, "assistant", response)
+    if idempotency_key:
+        # Shielded: a caller disconnecting doesn't cancel the turn a retry may be waiting on
+        return await asyncio.shield(_start_keyed_flight(("key",) + idempotency_key, fingerprint, run_turn))
+    return await _chat_flights.do(("body", fingerprint), run_turn)
+
+def _sse_event(payload):
+    """Format one Server-Sent Event"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+def _event_stream_response(events):
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _replay_events(result):
+    """A finished turn as stream events: the whole reply as one token, then done (or the error)"""
+    if "error" in result:
+        yield _sse_event({"type": "error", "error": result["error"]})
+        return
+    yield _sse_event({"type": "token", "content": result["response"]})
+    yield _sse_event({"type": "done", **result})
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: Request):
+    """Streaming variant of /chat: sends response tokens as Server-Sent Events.
+
+    Emits {"type": "token"} events while the model generates ({"type": "reset"}
+    means discard the tokens so far: the model went on to call a tool), then one
+    {"type": "done"} event (same fields as /chat) once the reply is stored,
+    or {"type": "error"} if the agent fails mid-stream. Idempotency keys
+    work as for /chat: a retry replays the stored result as one token event,
+    and a request whose turn is still running (a double-click, a rerun, or a
+    /chat with the same key) waits for it and replays its result, so the
+    agent runs and the turn is stored once. Reusing the key for a different
+    request is rejected with 409.
+    """
+    data = await request.json()
+    idempotency_key = _idempotency_key(request, data)
+    fingerprint = _chat_fingerprint(data)
+    replay = _idempotent_replay(idempotency_key, fingerprint) if idempotency_key else None
+    if isinstance(replay, JSONResponse):
+        return replay
+    if replay is not None:
+        return _event_stream_response(_replay_events(replay))
     
-    # Get updated chat history
-    updated_history = db.get_chat_history(session_id, limit=50)
+    flight_key = ("key",) + idempotency_key if idempotency_key else None
+    if flight_key and _chat_flights.running(flight_key):
+        flight = _chat_flights.start(flight_key, None)
+        
+        async def follow_stream():
+            try:
+                result = await asyncio.shield(flight)
+            except Exception as e:
+                yield _sse_event({"type": "error", "error": str(e)})
+                return
+            async for event in _replay_events(result):
+                yield event
+        
+        return _event_stream_response(follow_stream())
     
-    # Return response and chat history
-    return {
-        "response": response, 
-        "history": updated_history,
-        "session_id": session_id,
-        "user_id": user_id
-    }
+    events = asyncio.Queue()
+    
+    async def run_stream():
+        """Prepare, run the agent and store the turn, passing events to this request's stream.
+
+        The first event is the prepared turn (or its validation error); None ends the stream.
+        """
+        chunks = []
+        try:
+            # Database work runs in worker threads so a held write lock never stalls the event loop
+            with time_stage("prepare"):
+                turn = await asyncio.to_thread(prepare_chat_turn, data)
+            events.put_nowait(turn)
+            if "error" in turn:
+                return turn
+            
+            async for token in astream_response_from_ai_agent(turn["model_name"], turn["context_messages"], turn["allow_search"], turn["system_prompt"], turn["model_provider"], use_cache=turn["use_cache"]):
+                if token is STREAM_RESET:
+                    # The model called a tool; the text so far isn't part of the reply
+                    chunks.clear()
+                    events.put_nowait({"type": "reset"})
+                    continue
+                chunks.append(token)
+                events.put_nowait({"type": "token", "content": token})
+        finally:
+            events.put_nowait(None)
+        
+        # Persist the final assistant message once the stream completes
+        with time_stage("store"):
+            result = await asyncio.to_thread(finish_chat_turn, turn, "".join(chunks))
+        if idempotency_key:
+            _idempotent_results.set(idempotency_key, (fingerprint, result))
+        return result
+    
+    # Keyed turns run as a shared flight that finishes even if this client goes away; nothing awaits
+    # between the running() check above and this, so a duplicate can't start a second one
+    task = _start_keyed_flight(flight_key, fingerprint, run_stream) if flight_key else asyncio.ensure_future(run_stream())
+    
+    turn = await events.get()
+    if turn is None:
+        # Preparing the turn raised; surface it like any other endpoint error
+        await task
+    if "error" in turn:
+        # Validation errors are a plain JSON body, not an event stream
+        return turn
+    
+    async def event_stream():
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield _sse_event(event)
+            result = await asyncio.shield(task)
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            yield _sse_event({"type": "error", "error": str(e)})
+            return
+        finally:
+            if not flight_key and not task.done():
+                # Nobody else is waiting on an unkeyed turn; stop the agent when the client leaves
+                task.cancel()
+        yield _sse_event({"type": "done", **result})
+    
+    return _event_stream_response(event_stream())
 
 @app.post("/user/sessions")
 async def get_user_sessions(request: Request):
@@ -105,8 +512,8 @@ async def get_user_sessions(request: Request):
     if not user_email:
         return {"error": "user_email required"}
     
-    user_id = db.create_or_get_user(user_email, data.get("user_name", "User"))
-    sessions = db.get_user_chat_sessions(user_id)
+    user_id = await asyncio.to_thread(db.create_or_get_user, user_email, data.get("user_name", "User"))
+    sessions = await asyncio.to_thread(db.get_user_chat_sessions, user_id)
     return {"sessions": sessions}
 
 @app.post("/session/create")
@@ -119,20 +526,53 @@ async def create_session(request: Request):
     if not user_email:
         return {"error": "user_email required"}
     
-    user_id = db.create_or_get_user(user_email, data.get("user_name", "User"))
-    session_id = db.create_chat_session(user_id, session_name)
+    user_id = await asyncio.to_thread(db.create_or_get_user, user_email, data.get("user_name", "User"))
+    session_id = await asyncio.to_thread(db.create_chat_session, user_id, session_name)
     return {"session_id": session_id}
 
+def _int_field(data, name):
+    """An optional integer request field (None if absent or null); raises ValueError for anything else"""
+    value = data.get(name)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+        raise ValueError(f"{name} must be an integer")
+    return value
+
 @app.post("/session/history")
 async def get_session_history(request: Request):
-    """Get chat history for a specific session"""
+    """Get chat history for a specific session.
+
+    Returns the most recent `limit` messages (max 100). Pass `before_id` to
+    page towards older messages or `after_id` to fetch newer ones; `has_more`
+    says whether another page exists in that direction.
+    """
     data = await request.json()
     session_id = data.get("session_id")
     if not session_id:
         return {"error": "session_id required"}
     
-    history = db.get_chat_history(session_id, limit=100)
-    return {"history": history}
+    try:
+        session_id = _int_field(data, "session_id")
+        limit = _int_field(data, "limit")
+        before_id = _int_field(data, "before_id")
+        after_id = _int_field(data, "after_id")
+    except ValueError as e:
+        return {"error": str(e)}
+    limit = max(1, min(limit if limit is not None else 100, 100))
+    
+    # Fetch one extra row to know whether another page exists
+    history = await asyncio.to_thread(db.get_chat_history, session_id, limit=limit + 1,
+                                      before_id=before_id, after_id=after_id)
+    has_more = len(history) > limit
+    if has_more:
+        # Drop the extra row from the far end of the page
+        history = history[:limit] if after_id is not None else history[1:]
+    
+    return {
+        "history": history,
+        "has_more": has_more,
+        "oldest_id": history[0]['id'] if history else None,
+        "newest_id": history[-1]['id'] if history else None
+    }
 
 @app.post("/user/personalization")
 async def update_personalization(request: Request):
@@ -142,7 +582,7 @@ async def update_personalization(request: Request):
     if not user_email:
         return {"error": "user_email required"}
     
-    user_id = db.create_or_get_user(user_email, data.get("user_name", "User"))
+    user_id = await asyncio.to_thread(db.create_or_get_user, user_email, data.get("user_name", "User"))
     
     # Extract personalization fields
     updates = {}
@@ -151,7 +591,7 @@ async def update_personalization(request: Request):
             updates[key] = data[key]
     
     if updates:
-        db.update_user_personalization(user_id, **updates)
+        await asyncio.to_thread(db.update_user_personalization, user_id, **updates)
     
     return {"success": True}
 
@@ -163,29 +603,23 @@ async def get_personalization(request: Request):
     if not user_email:
         return {"error": "user_email required"}
     
-    user_id = db.create_or_get_user(user_email, data.get("user_name", "User"))
-    personalization = db.get_user_personalization(user_id)
+    user_id = await asyncio.to_thread(db.create_or_get_user, user_email, data.get("user_name", "User"))
+    personalization = await asyncio.to_thread(db.get_user_personalization, user_id)
     return personalization
 
 @app.post("/user/personalization/update")
 async def update_personalization_incremental(request: Request):
-    """Incrementally update user's personalization based on conversation analysis"""
+    """Incrementally update user's personalization based on conversation analysis.
+
+    Updates are queued for the background learner, which merges them (topics
+    are unioned, unchanged fields skipped) and writes them in batches.
+    """
     data = await request.json()
     user_email = data.get("user_email")
     if not user_email:
         return {"error": "user_email required"}
     
-    user_id = db.create_or_get_user(user_email, data.get("user_name", "User"))
-    
-    # Get current personalization
-    current = db.get_user_personalization(user_id)
-    
-    # Merge favorite topics intelligently
-    if 'favorite_topics' in data:
-        existing_topics = set(current.get('favorite_topics', []))
-        new_topics = set(data['favorite_topics'])
-        merged_topics = list(existing_topics.union(new_topics))
-        data['favorite_topics'] = merged_topics[:10]  # Limit to 10 topics
+    user_id = await asyncio.to_thread(db.create_or_get_user, user_email, data.get("user_name", "User"))
     
     # Extract personalization fields for update
     updates = {}
@@ -194,9 +628,9 @@ async def update_personalization_incremental(request: Request):
             updates[key] = data[key]
     
     if updates:
-        db.update_user_personalization(user_id, **updates)
+        learner.submit_updates(user_id, updates)
     
-    return {"success": True, "updated": updates}
+    return {"success": True, "queued": updates}
 
 @app.post("/user/stats")
 async def get_user_stats(request: Request):
@@ -206,8 +640,8 @@ async def get_user_stats(request: Request):
     if not user_email:
         return {"error": "user_email required"}
     
-    user_id = db.create_or_get_user(user_email, data.get("user_name", "User"))
-    stats = db.get_user_stats(user_id)
+    user_id = await asyncio.to_thread(db.create_or_get_user, user_email, data.get("user_name", "User"))
+    stats = await asyncio.to_thread(db.get_user_stats, user_id)
     return stats
 
 #Step3: Run app & Explore Swagger UI Docs
@@ -0,0 +1,385 @@
+# Offline load test for the backend: synthetic users against a stubbed model
+#
+#   python benchmark.py --users 20 --turns 10                 # drive backend.app in-process
+#   python benchmark.py --serve --port 9999                   # run the backend with the stub model...
+#   python benchmark.py --url http://127.0.0.1:9999           # ...and load it over localhost
+#   python benchmark.py --output new.json --compare old.json  # save results and diff against a previous run
+import argparse
+import asyncio
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Settings reported with every run, so results are only compared like for like
+REPORTED_SETTINGS = ["DB_POOL_SIZE", "AGENT_MAX_CONCURRENCY", "RESPONSE_CACHE_ENABLED", "SUMMARY_ENABLED",
+                     "CONTEXT_TOKEN_BUDGET", "PROFILE_SAMPLE_RATE"]
+
+BENCHMARK_MODEL = "llama-3.3-70b-versatile"
+BENCHMARK_PROVIDER = "Groq"
+SAMPLE_MESSAGES = [
+    "hey, how was your day?",
+    "I watched a great movie last night lol",
+    "what should I cook for dinner?",
+    "planning a trip to the beach next month",
+    "work has been kind of stressful lately",
+    "any good book recommendations?",
+    "haha that's funny",
+    "I started learning guitar 🎸🎶🎵",
+]
+
+
+class StubAgent:
+    """Stands in for the compiled ReAct agent: waits like a model call, then returns a canned reply"""
+
+    def __init__(self, latency: float, reply_words: int):
+        self.latency = latency
+        self.reply_words = reply_words
+
+    def _reply(self, state) -> str:
+        last = state["messages"][-1].content
+        return " ".join(["sure"] * max(0, self.reply_words - 1) + [f"({len(last)} chars)"])
+
+    def _result(self, state):
+        from langchain_core.messages.ai import AIMessage
+        return {"messages": state["messages"] + [AIMessage(content=self._reply(state))]}
+
+    def invoke(self, state, config=None):
+        time.sleep(self.latency)
+        return self._result(state)
+
+    async def ainvoke(self, state, config=None):
+        await asyncio.sleep(self.latency)
+        return self._result(state)
+
+    async def astream(self, state, config=None, stream_mode=None):
+        from langchain_core.messages.ai import AIMessageChunk
+        words = self._reply(state).split(" ")
+        for word in words:
+            await asyncio.sleep(self.latency / len(words))
+            yield AIMessageChunk(content=word + " "), {}
+
+
+def install_stub_model(latency: float, reply_words: int):
+    """Replace agent construction with StubAgent so no provider packages or API keys are needed.
+
+    Only the build step is patched, so the agent cache is exercised as in production.
+    """
+    import ai_agent
+    stub = StubAgent(latency, reply_words)
+    ai_agent._build_agent = lambda llm_id, allow_search, provider: stub
+
+
+class ASGITransport:
+    """Calls an ASGI app directly, without a server or sockets"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, body: Optional[Dict] = None, user: int = 0) -> Tuple[int, bytes, float]:
+        """Return (status, body, seconds until the first body chunk)"""
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path, "raw_path": path.encode("ascii"),
+            "query_string": b"", "root_path": "",
+            "headers": [(b"host", b"benchmark"), (b"content-type", b"application/json"),
+                        (b"content-length", str(len(payload)).encode("ascii"))],
+            "client": ("127.0.0.1", 0), "server": ("benchmark", 80),
+        }
+        received = False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            # Nothing more to send; wait like a connected client would
+            await asyncio.Event().wait()
+
+        status = 0
+        chunks = []
+        started = time.perf_counter()
+        first_byte = None
+
+        async def send(message):
+            nonlocal status, first_byte
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and message.get("body"):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                chunks.append(message["body"])
+
+        await self.app(scope, receive, send)
+        return status, b"".join(chunks), first_byte if first_byte is not None else time.perf_counter() - started
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """Calls a running backend over HTTP/1.1 keep-alive, one connection per virtual user"""
+
+    def __init__(self, base_url: str, users: int):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._executor = ThreadPoolExecutor(max_workers=max(1, users), thread_name_prefix="benchmark")
+        self._connections: Dict[int, http.client.HTTPConnection] = {}
+
+    def _request(self, user: int, method: str, path: str, payload: bytes) -> Tuple[int, bytes, float]:
+        conn = self._connections.get(user)
+        if conn is None:
+            conn = self._connections[user] = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=payload or None, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            first = response.read1() if hasattr(response, "read1") else response.read(1)
+            first_byte = time.perf_counter() - started
+            return response.status, first + response.read(), first_byte
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            del self._connections[user]
+            raise
+
+    async def request(self, method: str, path: str, body: Optional[Dict] = None, user: int = 0):
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._request, user, method, path, payload)
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._executor.shutdown(wait=False)
+
+
+class Recorder:
+    """Latency samples and error counts per endpoint"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.first_bytes: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, endpoint: str, seconds: float, first_byte: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        self.first_bytes.setdefault(endpoint, []).append(first_byte)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _is_error(status: int, body: bytes) -> bool:
+    # The backend reports validation problems as 200 {"error": ...}, and stream failures in-band
+    if status != 200:
+        return True
+    if body.startswith(b"data: "):
+        return b'"type": "error"' in body
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return True
+    return isinstance(payload, dict) and "error" in payload
+
+
+async def call(transport, recorder: Recorder, user: int, endpoint: str, body: Optional[Dict] = None,
+               method: str = "POST") -> Optional[Dict]:
+    """Time one request and return its JSON body (None for streams and failures)"""
+    started = time.perf_counter()
+    try:
+        status, payload, first_byte = await transport.request(method, endpoint, body, user=user)
+    except Exception:
+        elapsed = time.perf_counter() - started
+        recorder.record(endpoint, elapsed, elapsed, ok=False)
+        return None
+    recorder.record(endpoint, time.perf_counter() - started, first_byte, ok=not _is_error(status, payload))
+    if status != 200 or payload.startswith(b"data: "):
+        return None
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+async def virtual_user(transport, recorder: Recorder, user: int, args, rng: random.Random):
+    """One synthetic user: opens sessions and chats, with the reads the frontends make between turns"""
+    identity = {"user_email": f"bench-{args.run_id}-{user}@example.com", "user_name": f"Bench User {user}"}
+    await call(transport, recorder, user, "/user/personalization/get", identity)
+
+    for _ in range(args.sessions):
+        created = await call(transport, recorder, user, "/session/create", {**identity, "session_name": "Benchmark"})
+        session_id = created.get("session_id") if created else None
+        cursor = None
+
+        for turn in range(args.turns):
+            request = {
+                **identity,
+                "session_id": session_id,
+                "model_name": BENCHMARK_MODEL,
+                "model_provider": BENCHMARK_PROVIDER,
+                "messages": [rng.choice(SAMPLE_MESSAGES)],
+                "allow_search": False,
+                "personalize": True,
+                "since_id": cursor,
+            }
+            if rng.random() < args.stream_ratio:
+                await call(transport, recorder, user, "/chat/stream", request)
+            else:
+                result = await call(transport, recorder, user, "/chat", request)
+                if result:
+                    session_id = result.get("session_id", session_id)
+                    cursor = result.get("cursor", cursor)
+
+            if args.read_every and (turn + 1) % args.read_every == 0:
+                await call(transport, recorder, user, "/session/history", {"session_id": session_id, "limit": 20})
+                await call(transport, recorder, user, "/user/sessions", identity)
+            if args.think_time:
+                await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+def summarize(recorder: Recorder, wall_seconds: float) -> Dict:
+    endpoints = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        first_bytes = sorted(recorder.first_bytes[endpoint])
+        endpoints[endpoint] = {
+            'requests': len(ordered),
+            'errors': recorder.errors.get(endpoint, 0),
+            'throughput_rps': round(len(ordered) / wall_seconds, 2) if wall_seconds else 0.0,
+            'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+            'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+            'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+            'max_ms': round(ordered[-1] * 1000, 2),
+            'ttfb_p50_ms': round(percentile(first_bytes, 50) * 1000, 2),
+        }
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    return {
+        'wall_seconds': round(wall_seconds, 3),
+        'requests': total,
+        'errors': sum(recorder.errors.values()),
+        'throughput_rps': round(total / wall_seconds, 2) if wall_seconds else 0.0,
+        'endpoints': endpoints,
+    }
+
+
+def print_report(summary: Dict, baseline: Optional[Dict] = None):
+    header = f"{'endpoint':<28}{'reqs':>7}{'errs':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, stats in summary['endpoints'].items():
+        print(f"{endpoint:<28}{stats['requests']:>7}{stats['errors']:>6}{stats['throughput_rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+        previous = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if previous:
+            deltas = "".join(f"{_delta(stats[key], previous[key]):>10}" for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'))
+            print(f"{'  vs baseline':<41}{_delta(stats['throughput_rps'], previous['throughput_rps']):>9}{deltas}")
+    print(f"\n{summary['requests']} requests, {summary['errors']} errors in {summary['wall_seconds']}s "
+          f"({summary['throughput_rps']} req/s)")
+    if baseline:
+        print(f"baseline: {baseline['requests']} requests, {baseline['errors']} errors "
+              f"({baseline['throughput_rps']} req/s, {_delta(summary['throughput_rps'], baseline['throughput_rps'])})")
+
+
+def _delta(current: float, previous: float) -> str:
+    if not previous:
+        return "n/a"
+    return f"{(current - previous) / previous * 100:+.1f}%"
+
+
+async def run_benchmark(transport, args) -> Dict:
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(transport, recorder, user, args, random.Random(rng.random()))
+                           for user in range(args.users)))
+    return summarize(recorder, time.perf_counter() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the chat backend against a stubbed model")
+    parser.add_argument("--url", help="benchmark a running backend (default: drive backend.app in-process)")
+    parser.add_argument("--serve", action="store_true", help="run the backend with the stub model instead of benchmarking")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--users", type=int, default=20, help="concurrent synthetic users")
+    parser.add_argument("--sessions", type=int, default=1, help="sessions per user")
+    parser.add_argument("--turns", type=int, default=10, help="chat turns per session")
+    parser.add_argument("--stream-ratio", type=float, default=0.0, help="fraction of turns sent to /chat/stream")
+    parser.add_argument("--read-every", type=int, default=3, help="fetch history and sessions every N turns (0 disables)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds a user pauses between turns")
+    parser.add_argument("--model-latency", type=float, default=0.05, help="seconds each stubbed model call takes")
+    parser.add_argument("--reply-words", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="database file for in-process runs (default: a temporary file)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args(argv)
+    args.run_id = f"{int(time.time())}-{os.getpid()}"
+    scratch_dir = None
+
+    if not args.url:
+        # The backend opens its database at import time, so point it at a scratch file first
+        if not args.db:
+            scratch_dir = tempfile.TemporaryDirectory(prefix="chat-benchmark-")
+            args.db = os.path.join(scratch_dir.name, "benchmark.db")
+        os.environ["CHAT_DB_PATH"] = args.db
+        install_stub_model(args.model_latency, args.reply_words)
+        import backend
+
+        if args.serve:
+            import uvicorn
+            uvicorn.run(backend.app, host="127.0.0.1", port=args.port)
+            return 0
+        transport = ASGITransport(backend.app)
+    else:
+        transport = HTTPTransport(args.url, args.users)
+
+    try:
+        summary = asyncio.run(run_benchmark(transport, args))
+    finally:
+        transport.close()
+        if not args.url:
+            backend.shutdown_database()
+            if scratch_dir:
+                scratch_dir.cleanup()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)['summary']
+    print_report(summary, baseline)
+
+    if args.output:
+        results = {
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'target': args.url or "in-process",
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ("output", "compare", "run_id", "serve")},
+            'settings': {name: os.environ[name] for name in REPORTED_SETTINGS if name in os.environ},
+            'python': sys.version.split()[0],
+            'summary': summary,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+# In-process caches shared by the backend modules
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with optional TTL and hit/miss/eviction counters"""
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        # key -> (value, expires_at or None)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _lookup(self, key: Hashable, touch: bool = True):
+        """Return (found, value) for a live entry, marking it recently used if touch; caller holds the lock"""
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return False, None
+        if touch:
+            self._data.move_to_end(key)
+        return True, value
+
+    def _store(self, key: Hashable, value: Any):
+        """Insert a value and evict down to maxsize; caller holds the lock"""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value (marking it recently used) or default"""
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value or default without counting a hit or miss or changing its recency"""
+        with self._lock:
+            found, value = self._lookup(key, touch=False)
+            return value if found else default
+
+    def set(self, key: Hashable, value: Any):
+        """Insert or replace a value, evicting the least recently used entry if full"""
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the cached value, building it with factory() on a miss"""
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        # Build outside the lock so slow factories don't serialize other keys
+        value = factory()
+        with self._lock:
+            found, existing = self._lookup(key)
+            if found:
+                # Another thread won the race; keep its value
+                return existing
+            self._store(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a key and return its value"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[0] if entry is not None else default
+
+    def clear(self):
+        """Drop every entry (counters are kept)"""
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether a live entry exists (not counted as a hit or miss)"""
+        with self._lock:
+            return self._lookup(key)[0]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        """Snapshot of cache size and counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class SingleFlight:
+    """Coalesce concurrent async calls with the same key onto one execution (event-loop local)"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def start(self, key: Hashable, factory: Callable[[], Any]) -> asyncio.Task:
+        """Start factory() as a task under key, or return the task already running with that key"""
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return task
+
+    def running(self, key: Hashable) -> bool:
+        """Whether a call with this key is in flight"""
+        return key in self._calls
+
+    async def do(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Await factory() or, if a call with this key is already running, its result"""
+        # Shielded: a caller disconnecting doesn't cancel the call the others are waiting on
+        return await asyncio.shield(self.start(key, factory))
+
+    def stats(self) -> Dict:
+        """Snapshot of in-flight and coalesced call counts"""
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'coalesced': self.coalesced
+        }
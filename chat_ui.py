@@ -0,0 +1,152 @@
+# Transcript helpers shared by the Streamlit frontends
+import hashlib
+import textwrap
+from typing import Callable, Dict, List
+
+import streamlit as st
+
+from api_client import BackendClient
+
+# Number of messages fetched per history page ("Load older messages" fetches the next one)
+HISTORY_PAGE_SIZE = 30
+# Number of messages rendered per rerun ("Show earlier messages" expands by this much)
+RENDER_WINDOW = 20
+
+# A bubble template builds the chat bubble HTML for one message ({'role', 'content', ...})
+BubbleTemplate = Callable[[Dict], str]
+
+
+def init_transcript_state():
+    """Set up the session state the transcript helpers use"""
+    if 'history' not in st.session_state:
+        st.session_state['history'] = []
+    if 'history_has_more' not in st.session_state:
+        st.session_state['history_has_more'] = False
+    if 'render_window' not in st.session_state:
+        st.session_state['render_window'] = RENDER_WINDOW
+    if 'message_html' not in st.session_state:
+        st.session_state['message_html'] = {}
+
+
+def reset_transcript(history: List[Dict], has_more: bool):
+    """Replace the local history (e.g. on session switch) and reset rendering state"""
+    st.session_state['history'] = history
+    st.session_state['history_has_more'] = has_more
+    st.session_state['render_window'] = RENDER_WINDOW
+    st.session_state['message_html'] = {}
+
+
+def merge_history(new_messages: List[Dict]):
+    """Append messages from a /chat delta that aren't already in the local history"""
+    history = st.session_state['history']
+    last_id = history[-1].get('id', 0) if history else 0
+    history.extend(msg for msg in new_messages if msg['id'] > last_id)
+
+
+def history_cursor():
+    """Id of the newest message held locally (the /chat sync cursor)"""
+    history = st.session_state['history']
+    return history[-1].get('id') if history else None
+
+
+def idempotency_key(message: str) -> str:
+    """Key for one send: a double-click or rerun of the same message at the same point in the chat reuses it"""
+    raw = f"{st.session_state['user_email']}:{st.session_state['current_session_id']}:{history_cursor()}:{message}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def companion_message_html(msg: Dict) -> str:
+    """Bubble template of the companion frontends (user in blue, Aanya in pink)"""
+    if msg['role'] == 'user':
+        # User messages - Modern blue gradient
+        return f"""
+        <div style='display: flex; justify-content: flex-end; margin: 15px 0;'>
+            <div style='
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                color: white;
+                padding: 12px 16px;
+                border-radius: 18px 18px 4px 18px;
+                max-width: 70%;
+                box-shadow: 0 2px 10px rgba(102, 126, 234, 0.3);
+                font-size: 14px;
+                line-height: 1.4;
+                margin-left: 30%;
+            '>
+                <div style='font-weight: 600; font-size: 12px; color: rgba(255,255,255,0.8); margin-bottom: 4px;'>You</div>
+                {msg['content']}
+            </div>
+        </div>
+        """
+    # AI messages - Soft pink gradient for girlfriend personality
+    return f"""
+    <div style='display: flex; justify-content: flex-start; margin: 15px 0;'>
+        <div style='
+            background: linear-gradient(135deg, #ffecd2 0%, #fcb69f 100%);
+            color: #2c3e50;
+            padding: 12px 16px;
+            border-radius: 18px 18px 18px 4px;
+            max-width: 70%;
+            box-shadow: 0 2px 10px rgba(252, 182, 159, 0.3);
+            font-size: 14px;
+            line-height: 1.4;
+            margin-right: 30%;
+            border-left: 3px solid #ff6b6b;
+        '>
+            <div style='font-weight: 600; font-size: 12px; color: #e74c3c; margin-bottom: 4px;'>Aanya</div>
+            {msg['content']}
+        </div>
+    </div>
+    """
+
+
+def cached_message_html(msg: Dict, bubble: BubbleTemplate) -> str:
+    """Bubble HTML for a stored message, rendered once per message id"""
+    cache = st.session_state['message_html']
+    html = cache.get(msg.get('id'))
+    if html is None:
+        # Dedented so the joined transcript stays one HTML block for the markdown parser
+        html = textwrap.dedent(bubble(msg)).strip()
+        if msg.get('id') is not None:
+            cache[msg['id']] = html
+    return html
+
+
+def load_older_messages(api: BackendClient):
+    """Prepend the page of messages just before the oldest one shown"""
+    history = st.session_state['history']
+    if not history or 'id' not in history[0]:
+        return
+    try:
+        response = api.post("/session/history",
+                          json={
+                              "session_id": st.session_state['current_session_id'],
+                              "before_id": history[0]['id'],
+                              "limit": HISTORY_PAGE_SIZE
+                          }, idempotent=True)
+        if response.status_code == 200:
+            data = response.json()
+            older = data.get('history', [])
+            st.session_state['history'] = older + history
+            st.session_state['history_has_more'] = data.get('has_more', False)
+            # Show the page that was just fetched
+            st.session_state['render_window'] += len(older)
+        else:
+            st.error(f"Failed to load older messages: {response.text}")
+    except Exception as e:
+        st.error(f"Failed to load older messages: {str(e)}")
+
+
+def render_transcript(api: BackendClient, bubble: BubbleTemplate):
+    """Render the newest messages in one markdown call; older ones are shown on demand"""
+    history = st.session_state['history']
+    window = st.session_state['render_window']
+    hidden = max(0, len(history) - window)
+    if hidden:
+        if st.button(f"⬆️ Show {min(hidden, RENDER_WINDOW)} earlier messages", use_container_width=True):
+            st.session_state['render_window'] += RENDER_WINDOW
+            st.rerun()
+    elif st.session_state['history_has_more']:
+        if st.button("⬆️ Load older messages", use_container_width=True):
+            load_older_messages(api)
+            st.rerun()
+    st.markdown("\n".join(cached_message_html(msg, bubble) for msg in history[-window:]), unsafe_allow_html=True)
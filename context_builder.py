@@ -0,0 +1,74 @@
+# Token-budgeted chat context for the AI agent
+import os
+from typing import Dict, List, Optional, Tuple
+
+# Fast local token estimate: ~4 characters per token for BPE tokenizers on English text.
+# The 'token_count' column backfill in database.MIGRATIONS uses the same formula.
+CHARS_PER_TOKEN = 4
+# Per-message framing (role markers, separators) added by chat templates
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Prompt token budget per model; unknown models use the default (override via environment)
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "4096"))
+MODEL_CONTEXT_BUDGETS = {
+    "llama3-70b-8192": 4096,
+    "mixtral-8x7b-32768": 8192,
+    "llama-3.3-70b-versatile": 8192,
+    "gpt-4o-mini": 8192,
+}
+
+# Most recent stored messages considered when filling the budget (override via environment)
+CONTEXT_HISTORY_LIMIT = int(os.environ.get("CONTEXT_HISTORY_LIMIT", "100"))
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Estimate the token count of a piece of text without a tokenizer"""
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message: Dict) -> int:
+    """Tokens a message costs in the prompt, using its stored count when available"""
+    tokens = message.get('tokens')
+    if tokens is None:
+        tokens = estimate_tokens(message['content'])
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def get_context_budget(model_name: str) -> int:
+    """Get the prompt token budget for a model"""
+    return MODEL_CONTEXT_BUDGETS.get(model_name, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def build_context(history: List[Dict], new_messages: List[str], model_name: str,
+                  system_prompt: str = "", summary: Optional[str] = None,
+                  instructions: Optional[List[str]] = None) -> Tuple[List[Dict], int]:
+    """Build the role-tagged message list sent to the model and its estimated size.
+
+    The system prompt, any per-turn instructions (extra system messages kept
+    out of the system prompt so it stays stable), the session summary (if
+    any) and this turn's messages are always included; stored history (chronological dicts with 'role' and
+    'content', already past the summary) fills what is left of the model's
+    budget, newest first, stopping at the first message that doesn't fit so
+    the kept history stays contiguous.
+    """
+    budget = get_context_budget(model_name)
+    current = [{'role': 'user', 'content': content} for content in new_messages]
+    used = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS + sum(message_tokens(m) for m in current)
+
+    prefix = [{'role': 'system', 'content': instruction} for instruction in instructions or []]
+    if summary:
+        prefix.append({'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"})
+    used += sum(message_tokens(m) for m in prefix)
+
+    kept = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if used + cost > budget:
+            break
+        used += cost
+        kept.append({'role': message['role'], 'content': message['content']})
+    kept.reverse()
+
+    return prefix + kept + current, used
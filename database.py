@@ -1,214 +1,487 @@
 # Database management for personalized chat storage
 import sqlite3
 import json
-from datetime import datetime
-from typing import List, Dict, Optional
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import List, Dict, Optional, Tuple
 import hashlib
+import itertools
 
-class ChatDatabase:
-    def __init__(self, db_path: str = "chat_database.db"):
-        self.db_path = db_path
-        self.init_database()
-    
-    def init_database(self):
-        """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+from cache import LRUCache
+from context_builder import estimate_tokens
+from metrics import time_stage
+from profiling import record_span
+
+logger = logging.getLogger(__name__)
+
+# Database file used by the global instance (override via environment)
+CHAT_DB_PATH = os.environ.get("CHAT_DB_PATH", "chat_database.db")
+
+# Connection pool tuning (override via environment)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# Message retention (override via environment). Sessions keep their newest
+# MESSAGE_RETENTION_COUNT messages and, if MESSAGE_RETENTION_DAYS is set, drop
+# messages older than that. Either limit is disabled with 0. Pruning runs in a
+# background compaction pass every MESSAGE_COMPACTION_INTERVAL seconds rather
+# than on every insert.
+MESSAGE_RETENTION_COUNT = int(os.environ.get("MESSAGE_RETENTION_COUNT", "100"))
+MESSAGE_RETENTION_DAYS = float(os.environ.get("MESSAGE_RETENTION_DAYS", "0"))
+MESSAGE_COMPACTION_INTERVAL = float(os.environ.get("MESSAGE_COMPACTION_INTERVAL", "30"))
+
+# Identity cache (email -> user_id) and debounced last_login writes (override via environment)
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "600"))
+LAST_LOGIN_FLUSH_INTERVAL = float(os.environ.get("LAST_LOGIN_FLUSH_INTERVAL", "60"))
+
+# Personalization cache (user_id -> profile); the TTL bounds staleness across worker processes
+PERSONALIZATION_CACHE_SIZE = int(os.environ.get("PERSONALIZATION_CACHE_SIZE", "10000"))
+PERSONALIZATION_CACHE_TTL = float(os.environ.get("PERSONALIZATION_CACHE_TTL", "300"))
+
+# Largest INTEGER PRIMARY KEY SQLite can assign (open upper bound for id cursors)
+MAX_ROWID = 2 ** 63 - 1
+
+
+# Schema migrations, applied in order by ChatDatabase.init_database.
+# Each entry is (version, description, statements); the applied version is
+# stored in PRAGMA user_version. Never edit a released migration - append a new one.
+MIGRATIONS = [
+    (1, "Base tables", [
         # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                profile_picture TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP,
-                preferences TEXT DEFAULT '{}'
-            )
-        ''')
-        
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            profile_picture TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            preferences TEXT DEFAULT '{}'
+        )
+        ''',
         # Chat sessions table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                session_name TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
+        '''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
         # Chat messages table (store last 100 messages per session)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER NOT NULL,
-                role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
-            )
-        ''')
-        
+        '''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+        ''',
         # User preferences/personalization data
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_personalization (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                personality_type TEXT DEFAULT 'girlfriend',
-                custom_prompt TEXT,
-                favorite_topics TEXT DEFAULT '[]',
-                conversation_style TEXT DEFAULT 'casual',
-                emoji_preference TEXT DEFAULT 'rare',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-    
+        '''
+        CREATE TABLE IF NOT EXISTS user_personalization (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            personality_type TEXT DEFAULT 'girlfriend',
+            custom_prompt TEXT,
+            favorite_topics TEXT DEFAULT '[]',
+            conversation_style TEXT DEFAULT 'casual',
+            emoji_preference TEXT DEFAULT 'rare',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        '''
+    ]),
+    (2, "Secondary indexes for session, history and personalization lookups", [
+        # History reads and retention filter by session and walk messages in id order
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_session_id ON chat_messages (session_id, id)",
+        # Session list is per user, newest activity first
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_updated ON chat_sessions (user_id, updated_at DESC)",
+        # One personalization row per user: keep the oldest (the row reads already returned)
+        '''
+        DELETE FROM user_personalization
+        WHERE id NOT IN (SELECT MIN(id) FROM user_personalization GROUP BY user_id)
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_personalization_user ON user_personalization (user_id)"
+    ]),
+    (3, "Timestamp index for age-based message retention", [
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_timestamp ON chat_messages (timestamp)"
+    ]),
+    (4, "Per-message token estimates and running per-session token totals", [
+        "ALTER TABLE chat_messages ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE chat_sessions ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0",
+        # Backfill with context_builder.estimate_tokens: ceil(characters / 4)
+        "UPDATE chat_messages SET token_count = (LENGTH(content) + 3) / 4",
+        '''
+        UPDATE chat_sessions SET token_count = (
+            SELECT COALESCE(SUM(token_count), 0) FROM chat_messages WHERE session_id = chat_sessions.id
+        )
+        '''
+    ]),
+    (5, "Rolling conversation summary per session", [
+        "ALTER TABLE chat_sessions ADD COLUMN summary TEXT",
+        # Id of the newest message folded into the summary (0 = nothing summarized yet)
+        "ALTER TABLE chat_sessions ADD COLUMN summary_through_id INTEGER NOT NULL DEFAULT 0"
+    ])
+]
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived SQLite connections"""
+
+    def __init__(self, db_path: str, max_size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT,
+                 busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS, cache_size_kb: int = DB_CACHE_SIZE_KB,
+                 mmap_size: int = DB_MMAP_SIZE):
+        self.db_path = db_path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+
+        self._cond = threading.Condition()
+        self._idle: List[sqlite3.Connection] = []
+        self._open = 0
+        self._waiting = 0
+        self._closed = False
+
+        # Counters reported by stats()
+        self._created = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """Open a new connection and apply the performance pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False  # Connections move between worker threads
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Borrow a connection, opening one if the pool has room or waiting otherwise"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Connection pool is closed")
+
+            if not self._idle and self._open >= self.max_size:
+                self._waits += 1
+                self._waiting += 1
+                started = time.perf_counter()
+                try:
+                    available = self._cond.wait_for(
+                        lambda: self._closed or self._idle or self._open < self.max_size,
+                        timeout=self.timeout
+                    )
+                finally:
+                    self._waiting -= 1
+                    self._wait_time += time.perf_counter() - started
+                    record_span("db_pool_wait", started)
+                if not available:
+                    self._timeouts += 1
+                    raise TimeoutError(f"Timed out after {self.timeout}s waiting for a database connection")
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+
+            self._acquired += 1
+            if self._idle:
+                return self._idle.pop()
+
+            # Reserve the slot before connecting outside the lock
+            self._open += 1
+            self._created += 1
+
+        try:
+            return self._create_connection()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a borrowed connection to the pool"""
+        with self._cond:
+            if self._closed:
+                self._open -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def discard(self, conn: sqlite3.Connection):
+        """Drop a broken connection instead of returning it to the pool"""
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """Close idle connections; borrowed ones are closed when released"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._open -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        """Snapshot of pool usage"""
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'waiting': self._waiting,
+                'created': self._created,
+                'acquired': self._acquired,
+                'waits': self._waits,
+                'wait_time_seconds': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+                'closed': self._closed
+            }
+
+
+class PeriodicWorker:
+    """Daemon thread that calls a function every `interval` seconds until stopped"""
+
+    def __init__(self, name: str, interval: float, target):
+        self.interval = interval
+        self.target = target
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.target()
+            except Exception:
+                # Keep the worker alive; the next pass retries
+                logger.exception("%s pass failed", self._thread.name)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the thread and wait for an in-progress pass to finish"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+
+class ChatUnitOfWork:
+    """Chat operations bound to one open transaction (see ChatDatabase.unit_of_work)"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        # Sessions that received messages, handed to retention on commit
+        self.touched_sessions = set()
+        # Users whose personalization changed, invalidated in the cache on commit
+        self.touched_personalization = set()
+
+    def get_user_id(self, email: str) -> Optional[int]:
+        """Look up a user's ID by email without writing"""
+        self.cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
+        user = self.cursor.fetchone()
+        return user[0] if user else None
+
+    def create_user(self, email: str, name: str, profile_picture: str = None) -> int:
+        """Create a user with default personalization"""
+        self.cursor.execute('''
+            INSERT INTO users (email, name, profile_picture, last_login)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (email, name, profile_picture))
+        user_id = self.cursor.lastrowid
+
+        # Create default personalization
+        self.cursor.execute('''
+            INSERT INTO user_personalization (user_id) VALUES (?)
+        ''', (user_id,))
+        return user_id
+
+    def touch_user_login(self, user_id: int):
+        """Update a user's last login time"""
+        self.cursor.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
+
+    def set_last_logins(self, logins: Dict[int, str]):
+        """Write a batch of {user_id: last_login} timestamps"""
+        self.cursor.executemany("UPDATE users SET last_login = ? WHERE id = ?",
+                                [(last_login, user_id) for user_id, last_login in logins.items()])
+
     def create_or_get_user(self, email: str, name: str, profile_picture: str = None) -> int:
         """Create new user or get existing user ID"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Try to get existing user
-        cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
-        user = cursor.fetchone()
-        
-        if user:
+        user_id = self.get_user_id(email)
+        if user_id:
             # Update last login
-            cursor.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE email = ?", (email,))
-            user_id = user[0]
-        else:
-            # Create new user
-            cursor.execute('''
-                INSERT INTO users (email, name, profile_picture, last_login) 
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (email, name, profile_picture))
-            user_id = cursor.lastrowid
-            
-            # Create default personalization
-            cursor.execute('''
-                INSERT INTO user_personalization (user_id) VALUES (?)
-            ''', (user_id,))
-        
-        conn.commit()
-        conn.close()
-        return user_id
-    
+            self.touch_user_login(user_id)
+            return user_id
+        return self.create_user(email, name, profile_picture)
+
     def create_chat_session(self, user_id: int, session_name: str = None) -> int:
         """Create a new chat session for user"""
         if not session_name:
             session_name = f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+
+        self.cursor.execute('''
             INSERT INTO chat_sessions (user_id, session_name) VALUES (?, ?)
         ''', (user_id, session_name))
-        
-        session_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return session_id
-    
+        return self.cursor.lastrowid
+
     def get_user_chat_sessions(self, user_id: int) -> List[Dict]:
         """Get all chat sessions for a user"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, session_name, created_at, updated_at 
-            FROM chat_sessions 
-            WHERE user_id = ? 
+        self.cursor.execute('''
+            SELECT id, session_name, created_at, updated_at, token_count
+            FROM chat_sessions
+            WHERE user_id = ?
             ORDER BY updated_at DESC
         ''', (user_id,))
-        
+
         sessions = []
-        for row in cursor.fetchall():
+        for row in self.cursor.fetchall():
             sessions.append({
                 'id': row[0],
                 'name': row[1],
                 'created_at': row[2],
-                'updated_at': row[3]
+                'updated_at': row[3],
+                'token_count': row[4]
             })
-        
-        conn.close()
         return sessions
-    
-    def add_message(self, session_id: int, role: str, content: str):
-        """Add a message to chat session (keep only last 100 messages)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Add new message
-        cursor.execute('''
-            INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)
-        ''', (session_id, role, content))
-        
-        # Keep only last 100 messages per session
-        cursor.execute('''
-            DELETE FROM chat_messages 
-            WHERE session_id = ? AND id NOT IN (
-                SELECT id FROM chat_messages 
-                WHERE session_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT 100
-            )
-        ''', (session_id, session_id))
-        
-        # Update session timestamp
-        cursor.execute('''
-            UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?
-        ''', (session_id,))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_chat_history(self, session_id: int, limit: int = 100) -> List[Dict]:
-        """Get chat history for a session"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT role, content, timestamp 
-            FROM chat_messages 
-            WHERE session_id = ? 
-            ORDER BY timestamp ASC 
-            LIMIT ?
-        ''', (session_id, limit))
-        
+
+    def get_session_token_count(self, session_id: int) -> int:
+        """Get the running token estimate of a session's stored messages"""
+        self.cursor.execute("SELECT token_count FROM chat_sessions WHERE id = ?", (session_id,))
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def get_session_summary(self, session_id: int) -> Dict:
+        """Get a session's rolling summary and the id of the last message it covers"""
+        self.cursor.execute("SELECT summary, summary_through_id FROM chat_sessions WHERE id = ?", (session_id,))
+        row = self.cursor.fetchone()
+        if row:
+            return {'summary': row[0], 'summary_through_id': row[1]}
+        return {'summary': None, 'summary_through_id': 0}
+
+    def update_session_summary(self, session_id: int, summary: str, through_id: int,
+                               previous_through_id: int) -> bool:
+        """Store a new summary if the session is still at previous_through_id; return whether it was stored"""
+        self.cursor.execute('''
+            UPDATE chat_sessions SET summary = ?, summary_through_id = ?
+            WHERE id = ? AND summary_through_id = ?
+        ''', (summary, through_id, session_id, previous_through_id))
+        return self.cursor.rowcount == 1
+
+    def add_messages(self, session_id: int, messages: List[Tuple[str, str]]) -> List[int]:
+        """Append (role, content) messages to a session in one batch and return their ids"""
+        if not messages:
+            return []
+
+        rows = [(session_id, role, content, estimate_tokens(content)) for role, content in messages]
+        self.cursor.executemany('''
+            INSERT INTO chat_messages (session_id, role, content, token_count) VALUES (?, ?, ?, ?)
+        ''', rows)
+
+        # We hold the write lock, so AUTOINCREMENT assigned consecutive ids ending at the last insert
+        last_id = self.cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        first_id = last_id - len(messages) + 1
+
+        # Update session timestamp and running token total
+        self.cursor.execute('''
+            UPDATE chat_sessions
+            SET updated_at = CURRENT_TIMESTAMP, token_count = token_count + ?
+            WHERE id = ?
+        ''', (sum(row[3] for row in rows), session_id))
+
+        self.touched_sessions.add(session_id)
+        return list(range(first_id, last_id + 1))
+
+    def get_chat_history(self, session_id: int, limit: int = 100, before_id: Optional[int] = None,
+                         after_id: Optional[int] = None) -> List[Dict]:
+        """Get chat history for a session in chronological order.
+
+        By default returns the most recent `limit` messages. Message ids are
+        the paging cursor: `before_id` returns the `limit` messages just older
+        than that id, `after_id` the `limit` messages just newer than it.
+        """
+        if after_id is not None:
+            self.cursor.execute('''
+                SELECT id, role, content, timestamp, token_count
+                FROM chat_messages
+                WHERE session_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (session_id, after_id, limit))
+            rows = self.cursor.fetchall()
+        else:
+            # Walk the index newest-first, then flip back to chronological order
+            self.cursor.execute('''
+                SELECT id, role, content, timestamp, token_count
+                FROM chat_messages
+                WHERE session_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (session_id, before_id if before_id is not None else MAX_ROWID, limit))
+            rows = self.cursor.fetchall()[::-1]
+
         messages = []
-        for row in cursor.fetchall():
+        for row in rows:
             messages.append({
-                'role': row[0],
-                'content': row[1],
-                'timestamp': row[2]
+                'id': row[0],
+                'role': row[1],
+                'content': row[2],
+                'timestamp': row[3],
+                'tokens': row[4]
             })
-        
-        conn.close()
         return messages
-    
+
+    def get_messages_page(self, after_id: int, limit: int) -> List[Tuple[int, int, int, str, str]]:
+        """Get (id, user_id, session_id, role, content) for the next `limit` messages after after_id, across all sessions"""
+        self.cursor.execute('''
+            SELECT cm.id, cs.user_id, cm.session_id, cm.role, cm.content
+            FROM chat_messages cm
+            JOIN chat_sessions cs ON cm.session_id = cs.id
+            WHERE cm.id > ?
+            ORDER BY cm.id
+            LIMIT ?
+        ''', (after_id, limit))
+        return self.cursor.fetchall()
+
     def get_user_personalization(self, user_id: int) -> Dict:
         """Get user's personalization settings"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT personality_type, custom_prompt, favorite_topics, 
-                   conversation_style, emoji_preference 
-            FROM user_personalization 
+        self.cursor.execute('''
+            SELECT personality_type, custom_prompt, favorite_topics,
+                   conversation_style, emoji_preference
+            FROM user_personalization
             WHERE user_id = ?
         ''', (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
+
+        result = self.cursor.fetchone()
         if result:
             return {
                 'personality_type': result[0],
@@ -218,16 +491,13 @@ class ChatDatabase:
                 'emoji_preference': result[4]
             }
         return {}
-    
+
     def update_user_personalization(self, user_id: int, **kwargs):
         """Update user's personalization settings"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         # Build dynamic UPDATE query
         fields = []
         values = []
-        
+
         for key, value in kwargs.items():
             if key in ['personality_type', 'custom_prompt', 'conversation_style', 'emoji_preference']:
                 fields.append(f"{key} = ?")
@@ -235,61 +505,471 @@ class ChatDatabase:
             elif key == 'favorite_topics':
                 fields.append("favorite_topics = ?")
                 values.append(json.dumps(value))
-        
+
         if fields:
             fields.append("updated_at = CURRENT_TIMESTAMP")
             values.append(user_id)
-            
+
             query = f"UPDATE user_personalization SET {', '.join(fields)} WHERE user_id = ?"
-            cursor.execute(query, values)
-            conn.commit()
-        
-        conn.close()
-    
+            self.cursor.execute(query, values)
+            self.touched_personalization.add(user_id)
+
     def delete_chat_session(self, session_id: int, user_id: int):
         """Delete a chat session and its messages"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         # Verify session belongs to user
-        cursor.execute("SELECT id FROM chat_sessions WHERE id = ? AND user_id = ?", (session_id, user_id))
-        if cursor.fetchone():
+        self.cursor.execute("SELECT id FROM chat_sessions WHERE id = ? AND user_id = ?", (session_id, user_id))
+        if self.cursor.fetchone():
             # Delete messages first
-            cursor.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
+            self.cursor.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
             # Delete session
-            cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
-            conn.commit()
-        
-        conn.close()
-    
+            self.cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+
     def get_user_stats(self, user_id: int) -> Dict:
         """Get user statistics"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         # Total sessions
-        cursor.execute("SELECT COUNT(*) FROM chat_sessions WHERE user_id = ?", (user_id,))
-        total_sessions = cursor.fetchone()[0]
-        
+        self.cursor.execute("SELECT COUNT(*) FROM chat_sessions WHERE user_id = ?", (user_id,))
+        total_sessions = self.cursor.fetchone()[0]
+
         # Total messages
-        cursor.execute('''
+        self.cursor.execute('''
             SELECT COUNT(*) FROM chat_messages cm
             JOIN chat_sessions cs ON cm.session_id = cs.id
             WHERE cs.user_id = ?
         ''', (user_id,))
-        total_messages = cursor.fetchone()[0]
-        
+        total_messages = self.cursor.fetchone()[0]
+
         # Days since joining
-        cursor.execute("SELECT created_at FROM users WHERE id = ?", (user_id,))
-        created_at = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        self.cursor.execute("SELECT created_at FROM users WHERE id = ?", (user_id,))
+        created_at = self.cursor.fetchone()[0]
+
         return {
             'total_sessions': total_sessions,
             'total_messages': total_messages,
             'member_since': created_at
         }
 
+
+class ChatDatabase:
+    def __init__(self, db_path: str = CHAT_DB_PATH, pool_size: int = DB_POOL_SIZE,
+                 retention_count: int = MESSAGE_RETENTION_COUNT, retention_days: float = MESSAGE_RETENTION_DAYS,
+                 compaction_interval: float = MESSAGE_COMPACTION_INTERVAL, user_cache_size: int = USER_CACHE_SIZE,
+                 user_cache_ttl: float = USER_CACHE_TTL, login_flush_interval: float = LAST_LOGIN_FLUSH_INTERVAL,
+                 personalization_cache_size: int = PERSONALIZATION_CACHE_SIZE,
+                 personalization_cache_ttl: float = PERSONALIZATION_CACHE_TTL):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, max_size=pool_size)
+        self.init_database()
+
+        # Identity cache; last_login updates are coalesced and written in batches
+        self._user_ids = LRUCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        self._pending_logins: Dict[int, str] = {}
+        self._logins_lock = threading.Lock()
+        self._login_flusher = None
+        if login_flush_interval > 0:
+            self._login_flusher = PeriodicWorker("login-flusher", login_flush_interval, self.flush_logins)
+            self._login_flusher.start()
+
+        # Write-through personalization cache: user_id -> (version, profile)
+        self._personalization = LRUCache(maxsize=personalization_cache_size, ttl=personalization_cache_ttl)
+        self._personalization_lock = threading.Lock()
+        self._personalization_versions = itertools.count(1)
+        # user_id -> [invalidation count, reads in flight], kept only while a read is in flight,
+        # so a read that raced with a write is never cached
+        self._personalization_generations: Dict[int, List[int]] = {}
+        self._generation_lock = threading.Lock()
+
+        # Retention: sessions written since the last compaction pass
+        self.retention_count = retention_count
+        self.retention_days = retention_days
+        self._dirty_sessions = set()
+        self._dirty_lock = threading.Lock()
+        self._compactor = None
+        if compaction_interval > 0 and (retention_count > 0 or retention_days > 0):
+            self._compactor = PeriodicWorker("message-compactor", compaction_interval, self.compact_messages)
+            self._compactor.start()
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection; commit on success, roll back on error"""
+        with time_stage("db"):
+            conn = self.pool.acquire()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    # The connection is unusable; don't hand it out again
+                    self.pool.discard(conn)
+                    raise
+                self.pool.release(conn)
+                raise
+            self.pool.release(conn)
+
+    def get_pool_stats(self) -> Dict:
+        """Get connection pool statistics"""
+        return self.pool.stats()
+
+    def get_cache_stats(self) -> Dict:
+        """Get in-process cache statistics"""
+        with self._logins_lock:
+            pending_logins = len(self._pending_logins)
+        return {
+            'users': self._user_ids.stats(),
+            'pending_logins': pending_logins,
+            'personalization': self._personalization.stats()
+        }
+
+    def close(self):
+        """Flush pending writes, run a final compaction and close all pooled connections (call on application shutdown)"""
+        for worker in (self._login_flusher, self._compactor):
+            if worker:
+                worker.stop()
+        self.flush_logins()
+        self.compact_messages()
+        self.pool.close()
+
+    def init_database(self):
+        """Initialize the database schema by applying any pending migrations"""
+        with self._connection() as conn:
+            # Take the write lock up front so concurrent workers migrate one at a time
+            conn.execute("BEGIN IMMEDIATE")
+            current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+            for version, description, statements in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+
+    def get_schema_version(self) -> int:
+        """Get the number of the last applied migration"""
+        with self._connection() as conn:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    @contextmanager
+    def unit_of_work(self, write: bool = True):
+        """Run several chat operations in one transaction: one lock, one commit.
+
+        write=True takes the write lock up front (BEGIN IMMEDIATE) so the
+        transaction can't fail part-way while upgrading from a read lock.
+        Use write=False for read-only work; it sees one consistent snapshot
+        and never blocks writers.
+        """
+        with self._connection() as conn:
+            # Waiting on another writer's lock (busy_timeout) shows up in this stage
+            with time_stage("db_begin", write=write):
+                conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            uow = ChatUnitOfWork(conn)
+            yield uow
+
+        if uow.touched_sessions:
+            with self._dirty_lock:
+                self._dirty_sessions.update(uow.touched_sessions)
+        for user_id in uow.touched_personalization:
+            self._invalidate_personalization(user_id)
+
+    def create_or_get_user(self, email: str, name: str, profile_picture: str = None) -> int:
+        """Create new user or get existing user ID.
+
+        Known users are served from the identity cache (or a read-only
+        lookup) and their last_login is recorded for the next batched flush,
+        so this only takes the write lock when a user is created.
+        """
+        user_id = self._user_ids.get(email)
+        if user_id is None:
+            with self.unit_of_work(write=False) as uow:
+                user_id = uow.get_user_id(email)
+            if user_id is None:
+                with self.unit_of_work() as uow:
+                    # Re-check under the write lock in case another request just created them
+                    user_id = uow.get_user_id(email) or uow.create_user(email, name, profile_picture)
+            self._user_ids.set(email, user_id)
+
+        self.record_login(user_id)
+        return user_id
+
+    def record_login(self, user_id: int):
+        """Note a user's activity; last_login is written by the next flush_logins pass"""
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')  # Same format as CURRENT_TIMESTAMP
+        with self._logins_lock:
+            self._pending_logins[user_id] = now
+
+    def flush_logins(self) -> int:
+        """Write all pending last_login updates in one batch and return how many were written"""
+        with self._logins_lock:
+            logins = self._pending_logins
+            self._pending_logins = {}
+        if not logins:
+            return 0
+
+        try:
+            with self.unit_of_work() as uow:
+                uow.set_last_logins(logins)
+        except Exception:
+            # Put them back (newer activity wins) so the next pass retries
+            with self._logins_lock:
+                for user_id, last_login in logins.items():
+                    self._pending_logins.setdefault(user_id, last_login)
+            raise
+        return len(logins)
+
+    def create_chat_session(self, user_id: int, session_name: str = None) -> int:
+        """Create a new chat session for user"""
+        with self.unit_of_work() as uow:
+            return uow.create_chat_session(user_id, session_name)
+
+    def get_user_chat_sessions(self, user_id: int) -> List[Dict]:
+        """Get all chat sessions for a user"""
+        with self.unit_of_work(write=False) as uow:
+            return uow.get_user_chat_sessions(user_id)
+
+    def add_message(self, session_id: int, role: str, content: str) -> int:
+        """Add a message to chat session and return its id (retention is applied by compact_messages)"""
+        return self.add_messages(session_id, [(role, content)])[0]
+
+    def add_messages(self, session_id: int, messages: List[Tuple[str, str]]) -> List[int]:
+        """Add several (role, content) messages in one transaction and return their ids"""
+        with self.unit_of_work() as uow:
+            return uow.add_messages(session_id, messages)
+
+    def get_session_token_count(self, session_id: int) -> int:
+        """Get the running token estimate of a session's stored messages"""
+        with self.unit_of_work(write=False) as uow:
+            return uow.get_session_token_count(session_id)
+
+    def get_session_summary(self, session_id: int) -> Dict:
+        """Get a session's rolling summary and the id of the last message it covers"""
+        with self.unit_of_work(write=False) as uow:
+            return uow.get_session_summary(session_id)
+
+    def update_session_summary(self, session_id: int, summary: str, through_id: int,
+                               previous_through_id: int) -> bool:
+        """Store a new session summary unless another update got there first"""
+        with self.unit_of_work() as uow:
+            return uow.update_session_summary(session_id, summary, through_id, previous_through_id)
+
+    def compact_messages(self) -> int:
+        """Apply the retention policy in one batched transaction and return the number of rows deleted.
+
+        Count-based retention only revisits sessions written since the last
+        pass; age-based retention sweeps the whole table via the timestamp index.
+        Running token totals of the affected sessions are recomputed afterwards.
+        """
+        with self._dirty_lock:
+            session_ids = list(self._dirty_sessions)
+            self._dirty_sessions.clear()
+
+        deleted = 0
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+
+                if self.retention_count > 0 and session_ids:
+                    # Delete everything at or below the first id past the newest N
+                    cursor.executemany('''
+                        DELETE FROM chat_messages
+                        WHERE session_id = ? AND id <= (
+                            SELECT id FROM chat_messages
+                            WHERE session_id = ?
+                            ORDER BY id DESC
+                            LIMIT 1 OFFSET ?
+                        )
+                    ''', [(session_id, session_id, self.retention_count) for session_id in session_ids])
+                    deleted += cursor.rowcount
+
+                affected = set(session_ids) if self.retention_count > 0 else set()
+                if self.retention_days > 0:
+                    cutoff = f"-{self.retention_days} days"
+                    cursor.execute('''
+                        SELECT session_id FROM chat_messages WHERE timestamp < datetime('now', ?)
+                    ''', (cutoff,))
+                    affected.update(row[0] for row in cursor.fetchall())
+                    cursor.execute('''
+                        DELETE FROM chat_messages WHERE timestamp < datetime('now', ?)
+                    ''', (cutoff,))
+                    deleted += cursor.rowcount
+
+                if deleted:
+                    cursor.executemany('''
+                        UPDATE chat_sessions SET token_count = (
+                            SELECT COALESCE(SUM(token_count), 0) FROM chat_messages WHERE session_id = ?
+                        )
+                        WHERE id = ?
+                    ''', [(session_id, session_id) for session_id in affected])
+        except Exception:
+            # Retry these sessions on the next pass
+            with self._dirty_lock:
+                self._dirty_sessions.update(session_ids)
+            raise
+
+        return deleted
+
+    def get_chat_history(self, session_id: int, limit: int = 100, before_id: Optional[int] = None,
+                         after_id: Optional[int] = None) -> List[Dict]:
+        """Get chat history for a session (see ChatUnitOfWork.get_chat_history for paging)"""
+        with self.unit_of_work(write=False) as uow:
+            return uow.get_chat_history(session_id, limit, before_id, after_id)
+
+    def iter_messages(self, batch_size: int = 1000):
+        """Yield (id, user_id, session_id, role, content) for every stored message in id order.
+
+        Reads in keyset-paged batches, each in its own short read transaction,
+        so a full pass never holds a snapshot open for long.
+        """
+        after_id = 0
+        while True:
+            with self.unit_of_work(write=False) as uow:
+                rows = uow.get_messages_page(after_id, batch_size)
+            if not rows:
+                return
+            yield from rows
+            after_id = rows[-1][0]
+
+    def get_user_personalization(self, user_id: int) -> Dict:
+        """Get user's personalization settings, served from the in-process cache.
+
+        The result includes a 'version' that changes whenever the profile
+        does, so callers can key derived data (e.g. prompts) on it.
+        """
+        entry = self._personalization.get(user_id)
+        if entry is None:
+            with self._personalization_read(user_id) as generation:
+                with self.unit_of_work(write=False) as uow:
+                    profile = uow.get_user_personalization(user_id)
+                if not profile:
+                    return {}
+                entry = (next(self._personalization_versions), profile)
+                self._cache_personalization(user_id, generation, entry)
+
+        version, profile = entry
+        # Copy so callers can't mutate the cached profile
+        return {**profile, 'favorite_topics': list(profile['favorite_topics']), 'version': version}
+
+    def update_user_personalization(self, user_id: int, **kwargs):
+        """Update user's personalization settings and write the result through to the cache"""
+        with self._personalization_lock, self._personalization_read(user_id) as generation:
+            # Not counted as a cache lookup: this is a write
+            previous = self._personalization.peek(user_id)
+            with self.unit_of_work() as uow:
+                uow.update_user_personalization(user_id, **kwargs)
+
+            # The commit invalidated the entry (one generation); re-cache the merged profile under a
+            # new version, unless another writer committed meanwhile and previous is out of date
+            if previous is not None:
+                profile = dict(previous[1])
+                for key, value in kwargs.items():
+                    if key in profile:
+                        profile[key] = list(value) if key == 'favorite_topics' else value
+                self._cache_personalization(user_id, generation + 1, (next(self._personalization_versions), profile))
+
+    @contextmanager
+    def _personalization_read(self, user_id: int):
+        """Track a profile read so commits during it are noticed; yields the generation it started at"""
+        with self._generation_lock:
+            state = self._personalization_generations.setdefault(user_id, [0, 0])
+            state[1] += 1
+            generation = state[0]
+        try:
+            yield generation
+        finally:
+            with self._generation_lock:
+                state[1] -= 1
+                if not state[1]:
+                    # No read left to protect; the next one starts counting afresh
+                    del self._personalization_generations[user_id]
+
+    def _invalidate_personalization(self, user_id: int):
+        """Drop the cached profile and bump the user's generation (called after a commit that changed it)"""
+        with self._generation_lock:
+            state = self._personalization_generations.get(user_id)
+            if state is not None:
+                state[0] += 1
+            self._personalization.pop(user_id)
+
+    def _cache_personalization(self, user_id: int, generation: int, entry: Tuple[int, Dict]):
+        """Cache a profile read at `generation` (inside _personalization_read), unless it has been invalidated since"""
+        with self._generation_lock:
+            state = self._personalization_generations.get(user_id)
+            if state is not None and state[0] == generation:
+                self._personalization.set(user_id, entry)
+
+    def delete_chat_session(self, session_id: int, user_id: int):
+        """Delete a chat session and its messages"""
+        with self.unit_of_work() as uow:
+            uow.delete_chat_session(session_id, user_id)
+
+    def get_user_stats(self, user_id: int) -> Dict:
+        """Get user statistics"""
+        with self.unit_of_work(write=False) as uow:
+            return uow.get_user_stats(user_id)
+
+def verify_query_plans() -> List[Dict]:
+    """EXPLAIN QUERY PLAN every statement ChatDatabase issues.
+
+    Runs each public method against a scratch database while tracing the SQL
+    it executes, then reports the plan of every SELECT/UPDATE/DELETE and
+    whether any table is read with a full SCAN instead of an index.
+    """
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scratch = ChatDatabase(os.path.join(tmp_dir, "explain.db"), pool_size=1, compaction_interval=0,
+                               login_flush_interval=0)
+        statements = []
+        conn = scratch.pool.acquire()
+        conn.set_trace_callback(statements.append)
+        scratch.pool.release(conn)
+
+        # Exercise every query path
+        user_id = scratch.create_or_get_user("explain@example.com", "Explain")
+        scratch.create_or_get_user("explain@example.com", "Explain")
+        scratch.flush_logins()
+        session_id = scratch.create_chat_session(user_id)
+        scratch.get_user_chat_sessions(user_id)
+        scratch.add_message(session_id, "user", "hello")
+        scratch.add_messages(session_id, [("user", "hi"), ("assistant", "hey")])
+        scratch.get_session_token_count(session_id)
+        scratch.update_session_summary(session_id, "greetings", 1, 0)
+        scratch.get_session_summary(session_id)
+        scratch.retention_count = 1
+        scratch.retention_days = 30
+        scratch.compact_messages()
+        scratch.get_chat_history(session_id)
+        scratch.get_chat_history(session_id, before_id=1)
+        scratch.get_chat_history(session_id, after_id=1)
+        list(scratch.iter_messages())
+        scratch.update_user_personalization(user_id, conversation_style="casual", favorite_topics=[])
+        scratch.get_user_personalization(user_id)
+        scratch.get_user_stats(user_id)
+        scratch.delete_chat_session(session_id, user_id)
+
+        with scratch._connection() as conn:
+            conn.set_trace_callback(None)
+            seen = set()
+            for statement in statements:
+                sql = " ".join(statement.split())
+                if sql in seen or not sql.upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                    continue
+                seen.add(sql)
+                plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+                full_scans = [step for step in plan if step.startswith("SCAN ") and step != "SCAN CONSTANT ROW"]
+                report.append({'sql': sql, 'plan': plan, 'uses_index': not full_scans})
+        scratch.close()
+    return report
+
 # Global database instance
 db = ChatDatabase()
+
+if __name__ == "__main__":
+    import sys
+
+    if "--explain" in sys.argv:
+        results = verify_query_plans()
+        for result in results:
+            status = "OK  " if result['uses_index'] else "SCAN"
+            print(f"[{status}] {result['sql']}")
+            for step in result['plan']:
+                print(f"         {step}")
+        sys.exit(0 if all(r['uses_index'] for r in results) else 1)
@@ -3,14 +3,24 @@
 # load_dotenv()
 
 import streamlit as st
-import requests
 import json
 import os
 from datetime import datetime
 
+from api_client import BackendClient
+from chat_ui import (HISTORY_PAGE_SIZE, companion_message_html, history_cursor, idempotency_key,
+                     init_transcript_state, merge_history, render_transcript, reset_transcript)
+
 # Backend URL
 BACKEND_URL = os.environ.get("BACKEND_URL", "https://ai-chatbot-2-9dbh.onrender.com")
 
+# Shared backend client: one pool of keep-alive connections per Streamlit server process, reused across reruns
+@st.cache_resource
+def get_api_client():
+    return BackendClient(BACKEND_URL)
+
+api = get_api_client()
+
 # Initialize session state for authentication and user management
 if 'authenticated' not in st.session_state:
     st.session_state['authenticated'] = False
@@ -24,15 +34,14 @@ if 'chat_sessions' not in st.session_state:
     st.session_state['chat_sessions'] = []
 if 'current_session_id' not in st.session_state:
     st.session_state['current_session_id'] = None
-if 'history' not in st.session_state:
-    st.session_state['history'] = []
+init_transcript_state()
 
 def authenticate_user(email, name):
     """Simple authentication - create or get user"""
     try:
         # Create or get user from backend
-        response = requests.post(f"{BACKEND_URL}/user/sessions", 
-                               json={"user_email": email, "user_name": name})
+        response = api.post("/user/sessions", 
+                          json={"user_email": email, "user_name": name}, idempotent=True)
         if response.status_code == 200:
             st.session_state['authenticated'] = True
             st.session_state['user_email'] = email
@@ -46,8 +55,8 @@ def authenticate_user(email, name):
 def load_user_sessions():
     """Load user's chat sessions from backend"""
     try:
-        response = requests.post(f"{BACKEND_URL}/user/sessions", 
-                               json={"user_email": st.session_state['user_email']})
+        response = api.post("/user/sessions", 
+                          json={"user_email": st.session_state['user_email']}, idempotent=True)
         if response.status_code == 200:
             data = response.json()
             st.session_state['chat_sessions'] = data.get('sessions', [])
@@ -55,13 +64,13 @@ def load_user_sessions():
         st.error(f"Failed to load sessions: {str(e)}")
 
 def load_session_history(session_id):
-    """Load chat history for a specific session"""
+    """Load the most recent page of chat history for a specific session"""
     try:
-        response = requests.post(f"{BACKEND_URL}/session/history", 
-                               json={"session_id": session_id})
+        response = api.post("/session/history", 
+                          json={"session_id": session_id, "limit": HISTORY_PAGE_SIZE}, idempotent=True)
         if response.status_code == 200:
             data = response.json()
-            st.session_state['history'] = data.get('history', [])
+            reset_transcript(data.get('history', []), data.get('has_more', False))
             st.session_state['current_session_id'] = session_id
         else:
             st.error(f"Failed to load history: {response.text}")
@@ -71,105 +80,57 @@ def load_session_history(session_id):
 def create_new_session():
     """Create a new chat session"""
     try:
-        response = requests.post(f"{BACKEND_URL}/session/create", 
-                               json={
-                                   "user_email": st.session_state['user_email'],
-                                   "user_name": st.session_state['user_name'],
-                                   "session_name": f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-                               })
+        response = api.post("/session/create", 
+                          json={
+                              "user_email": st.session_state['user_email'],
+                              "user_name": st.session_state['user_name'],
+                              "session_name": f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+                          })
         if response.status_code == 200:
             data = response.json()
             new_session_id = data['session_id']
             st.session_state['current_session_id'] = new_session_id
-            st.session_state['history'] = []
+            reset_transcript([], False)
             load_user_sessions()  # Refresh sessions list
             return new_session_id
     except Exception as e:
         st.error(f"Failed to create session: {str(e)}")
     return None
 
-def analyze_user_message(message, history):
-    """Analyze user message to extract interests, mood, and preferences for personalization"""
-    updates = {}
-    
-    # Extract interests from keywords
-    interests_keywords = {
-        'sports': ['football', 'basketball', 'soccer', 'tennis', 'gym', 'workout', 'exercise'],
-        'music': ['song', 'music', 'band', 'concert', 'guitar', 'piano', 'singing'],
-        'movies': ['movie', 'film', 'netflix', 'cinema', 'actor', 'actress', 'series'],
-        'food': ['food', 'cooking', 'recipe', 'restaurant', 'dinner', 'lunch', 'breakfast'],
-        'travel': ['travel', 'trip', 'vacation', 'holiday', 'flight', 'hotel', 'beach'],
-        'technology': ['tech', 'computer', 'phone', 'app', 'coding', 'programming', 'ai'],
-        'books': ['book', 'reading', 'novel', 'story', 'author', 'library'],
-        'games': ['game', 'gaming', 'xbox', 'playstation', 'nintendo', 'pc gaming']
-    }
-    
-    message_lower = message.lower()
-    detected_interests = []
-    
-    for category, keywords in interests_keywords.items():
-        if any(keyword in message_lower for keyword in keywords):
-            detected_interests.append(category)
-    
-    if detected_interests:
-        updates['favorite_topics'] = detected_interests
-    
-    # Detect conversation style preferences
-    if any(word in message_lower for word in ['lol', 'haha', 'funny', 'joke']):
-        updates['conversation_style'] = 'humorous'
-    elif any(word in message_lower for word in ['serious', 'important', 'concern']):
-        updates['conversation_style'] = 'serious'
-    elif any(word in message_lower for word in ['cute', 'sweet', 'love', 'miss']):
-        updates['conversation_style'] = 'romantic'
-    
-    # Detect emoji preferences
-    emoji_count = sum(1 for char in message if ord(char) > 127)
-    if emoji_count > 2:
-        updates['emoji_preference'] = 'frequent'
-    elif emoji_count == 0 and len(history) > 5:
-        updates['emoji_preference'] = 'rare'
-    
-    return {'updates': updates if updates else None}
+def stream_chat(payload, placeholder):
+    """Send a chat turn to the streaming endpoint, rendering tokens as they arrive.
 
-def create_personalized_prompt(user_profile, user_name):
-    """Create a personalized system prompt based on user's learned preferences"""
-    base_personality = "You're not a bot — you're my girlfriend. You talk like a real person: warm, caring, sometimes teasing or moody, but mostly chill and friendly. Keep replies short (under 30 words), honest, and natural. If someone says something unclear or confusing, respond naturally like 'I didn't get that' or 'What do you mean?' - don't be robotic about it.
-    # Customize based on user profile
-    style_additions = ""
-    
-    # Conversation style customization
-    conv_style = user_profile.get('conversation_style', 'casual')
-    if conv_style == 'humorous':
-        style_additions += " I love your sense of humor, so I'm often playful and witty with you."
-    elif conv_style == 'romantic':
-        style_additions += " You're so sweet and romantic, so I match that energy with warmth and affection.you are free to talk about sexual and romantic story"
-    elif conv_style == 'serious':
-        style_additions += " You appreciate deeper conversations, so I'm thoughtful and genuine with you."
-    
-    # Interest-based customization
-    interests = user_profile.get('favorite_topics', [])
-    if interests:
-        interests_text = ", ".join(interests)
-        style_additions += f" I know you're into {interests_text}, so I sometimes reference these interests naturally."
-    
-    # Emoji preference
-    emoji_pref = user_profile.get('emoji_preference', 'rare')
-    if emoji_pref == 'frequent':
-        style_additions += " You like emojis, so I use them more often when it feels right."
-    elif emoji_pref == 'rare':
-        style_additions += " You prefer cleaner text, so I use emojis sparingly."
-    
-    # Personality type
-    personality = user_profile.get('personality_type', 'girlfriend')
-    if personality == 'girlfriend':
-        style_additions += " I'm your girlfriend who knows you well - sometimes flirty, Mostly time just your best friend."
+    Returns the final event (response, history, session_id) or None on failure.
+    """
+    response = api.post("/chat/stream", json=payload, stream=True, idempotent=True)
+    if response.status_code != 200:
+        st.error(f"Backend error: {response.status_code} - {response.text}")
+        return None
     
-    # Custom prompt override
-    if user_profile.get('custom_prompt'):
-        return user_profile['custom_prompt'] + style_additions
+    # Validation errors come back as a plain JSON body instead of an event stream
+    if not response.headers.get('content-type', '').startswith('text/event-stream'):
+        st.error(f"Backend error: {response.json().get('error', response.text)}")
+        return None
     
-    return base_personality + style_additions + " You sound like someone I've really been dating — relaxed, playful, and a little flirty only sometimes. Don't be overly emotional or robotic. Use emojis only when it feels natural. If you're bored, annoyed, or happy — just say it like real people do. Keep it casual, real, and alive. Handle greetings like 'hi' warmly, and if something doesn't make sense, just ask what I mean in a natural way.
-    Chat in proper in girfriend mode"
+    partial = ""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data: "):
+            continue
+        event = json.loads(line[len("data: "):])
+        if event['type'] == 'token':
+            partial += event['content']
+            placeholder.markdown(companion_message_html({'role': 'assistant', 'content': partial + " ▌"}),
+                                 unsafe_allow_html=True)
+        elif event['type'] == 'reset':
+            # Text before a tool call isn't part of the reply
+            partial = ""
+            placeholder.empty()
+        elif event['type'] == 'done':
+            return event
+        elif event['type'] == 'error':
+            st.error(f"Backend error: {event['error']}")
+            return None
+    return None
 
 # Enhanced Authentication Section
 if not st.session_state['authenticated']:
@@ -321,48 +282,7 @@ if not st.session_state['current_session_id']:
 else:
     # Display chat history with beautiful styling
     if st.session_state['history']:
-        for msg in st.session_state['history']:
-            if msg['role'] == 'user':
-                # User messages - Modern blue gradient
-                st.markdown(f"""
-                <div style='display: flex; justify-content: flex-end; margin: 15px 0;'>
-                    <div style='
-                        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                        color: white;
-                        padding: 12px 16px;
-                        border-radius: 18px 18px 4px 18px;
-                        max-width: 70%;
-                        box-shadow: 0 2px 10px rgba(102, 126, 234, 0.3);
-                        font-size: 14px;
-                        line-height: 1.4;
-                        margin-left: 30%;
-                    '>
-                        <div style='font-weight: 600; font-size: 12px; color: rgba(255,255,255,0.8); margin-bottom: 4px;'>You</div>
-                        {msg['content']}
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                # AI messages - Soft pink gradient for girlfriend personality
-                st.markdown(f"""
-                <div style='display: flex; justify-content: flex-start; margin: 15px 0;'>
-                    <div style='
-                        background: linear-gradient(135deg, #ffecd2 0%, #fcb69f 100%);
-                        color: #2c3e50;
-                        padding: 12px 16px;
-                        border-radius: 18px 18px 18px 4px;
-                        max-width: 70%;
-                        box-shadow: 0 2px 10px rgba(252, 182, 159, 0.3);
-                        font-size: 14px;
-                        line-height: 1.4;
-                        margin-right: 30%;
-                        border-left: 3px solid #ff6b6b;
-                    '>
-                        <div style='font-weight: 600; font-size: 12px; color: #e74c3c; margin-bottom: 4px;'>Aanya</div>
-                        {msg['content']}
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+        render_transcript(api, companion_message_html)
     else:
         st.markdown("""
         <div style='
@@ -425,72 +345,36 @@ else:
             st.warning("⚠️ Please type something to chat with Aanya!")
             st.rerun()
         
-        # Get user personalization data from backend
-        try:
-            personalization_response = requests.post(f"{BACKEND_URL}/user/personalization/get", 
-                                                   json={"user_email": st.session_state['user_email']})
-            user_profile = personalization_response.json() if personalization_response.status_code == 200 else {}
-        except:
-            user_profile = {}
-        
-        # Analyze current message for learning (extract interests, mood, preferences)
-        message_analysis = analyze_user_message(user_input, st.session_state['history'])
-        
-        # Update user profile based on message analysis
-        if message_analysis.get('updates'):
-            try:
-                requests.post(f"{BACKEND_URL}/user/personalization/update", 
-                            json={
-                                "user_email": st.session_state['user_email'],
-                                **message_analysis['updates']
-                            })
-            except:
-                pass  # Silent fail for personalization updates
-        
-        # Prepare conversation history for context
-        recent_history = ""
-        if st.session_state['history']:
-            # Get last 10 messages for context (5 exchanges)
-            recent_messages = st.session_state['history'][-10:] if len(st.session_state['history']) > 10 else st.session_state['history']
-            history_context = []
-            for msg in recent_messages:
-                if msg['role'] == 'user':
-                    history_context.append(f"You: {msg['content']}")
-                else:
-                    history_context.append(f"Aanya: {msg['content']}")
-            recent_history = "\n".join(history_context)
-        
-        # Create personalized system prompt based on learned profile
-        base_prompt = create_personalized_prompt(user_profile, st.session_state['user_name'])
-        
-        if recent_history:
-            full_prompt = f"{base_prompt}\n\nOur recent conversation:\n{recent_history}\n\nBased on our conversation history and what I know about you, respond naturally and reference things we've talked about when relevant. Remember details about your life, interests, and feelings you've shared."
-        else:
-            full_prompt = f"{base_prompt}\n\nThis is the start of our conversation, so be warm and welcoming based on what I know about you!"
-        
+        # Profile lookup, message analysis, profile update and prompt personalization
+        # all happen server-side within this one request
         payload = {
             "user_email": st.session_state['user_email'],
             "user_name": st.session_state['user_name'],
             "session_id": st.session_state['current_session_id'],
             "model_name": "llama3-70b-8192",
             "model_provider": "Groq",
-            "system_prompt": full_prompt,
+            "personalize": True,
             "messages": [user_input],
-            "allow_search": False
+            "allow_search": False,
+            "since_id": history_cursor(),
+            "idempotency_key": idempotency_key(user_input)
         }
         
         try:
-            with st.spinner("AI is thinking..."):
-                response = requests.post(f"{BACKEND_URL}/chat", json=payload)
+            # Show the user's message right away, then stream Aanya's reply into place
+            st.markdown(companion_message_html({'role': 'user', 'content': user_input}), unsafe_allow_html=True)
+            reply_placeholder = st.empty()
+            result = stream_chat(payload, reply_placeholder)
             
-            if response.status_code == 200:
-                result = response.json()
-                # Update chat history from database
-                st.session_state['history'] = result.get('history', [])
+            if result:
+                if result.get('resync'):
+                    # Too far behind to catch up from the delta; reload the newest page
+                    load_session_history(result['session_id'])
+                else:
+                    # Merge only the messages this turn added
+                    merge_history(result.get('messages', []))
                 # Clear input by rerunning
                 st.rerun()
-            else:
-                st.error(f"Backend error: {response.status_code} - {response.text}")
         except Exception as e:
             st.error(f"Request failed: {str(e)}")
     
@@ -514,8 +398,8 @@ else:
         
         # Get current personalization
         try:
-            personalization_response = requests.post(f"{BACKEND_URL}/user/personalization/get", 
-                                                   json={"user_email": st.session_state['user_email']})
+            personalization_response = api.post("/user/personalization/get", 
+                                              json={"user_email": st.session_state['user_email']}, idempotent=True)
             current_profile = personalization_response.json() if personalization_response.status_code == 200 else {}
         except:
             current_profile = {}
@@ -561,7 +445,7 @@ else:
                 if custom_prompt.strip():
                     update_data["custom_prompt"] = custom_prompt.strip()
                 
-                response = requests.post(f"{BACKEND_URL}/user/personalization", json=update_data)
+                response = api.post("/user/personalization", json=update_data, idempotent=True)
                 if response.status_code == 200:
                     st.success("✅ Personalization settings saved! Aanya will adapt to your preferences.")
                 else:
@@ -3,13 +3,24 @@
 # load_dotenv()
 
 import streamlit as st
-import requests
 import json
 import os
 from datetime import datetime
 
+from api_client import BackendClient
+from chat_ui import (HISTORY_PAGE_SIZE, companion_message_html, history_cursor, idempotency_key,
+                     init_transcript_state, merge_history, render_transcript, reset_transcript)
+
 # Backend URL
 BACKEND_URL = os.environ.get("BACKEND_URL", "https://ai-chatbot-1-77o9.onrender.com")
+
+# Shared backend client: one pool of keep-alive connections per Streamlit server process, reused across reruns
+@st.cache_resource
+def get_api_client():
+    return BackendClient(BACKEND_URL)
+
+api = get_api_client()
+
 # Initialize session state for authentication and user management
 if 'authenticated' not in st.session_state:
     st.session_state['authenticated'] = False
@@ -23,15 +34,14 @@ if 'chat_sessions' not in st.session_state:
     st.session_state['chat_sessions'] = []
 if 'current_session_id' not in st.session_state:
     st.session_state['current_session_id'] = None
-if 'history' not in st.session_state:
-    st.session_state['history'] = []
+init_transcript_state()
 
 def authenticate_user(email, name):
     """Simple authentication - create or get user"""
     try:
         # Create or get user from backend
-        response = requests.post(f"{BACKEND_URL}/user/sessions", 
-                               json={"user_email": email, "user_name": name})
+        response = api.post("/user/sessions", 
+                          json={"user_email": email, "user_name": name}, idempotent=True)
         if response.status_code == 200:
             st.session_state['authenticated'] = True
             st.session_state['user_email'] = email
@@ -45,8 +55,8 @@ def authenticate_user(email, name):
 def load_user_sessions():
     """Load user's chat sessions from backend"""
     try:
-        response = requests.post(f"{BACKEND_URL}/user/sessions", 
-                               json={"user_email": st.session_state['user_email']})
+        response = api.post("/user/sessions", 
+                          json={"user_email": st.session_state['user_email']}, idempotent=True)
         if response.status_code == 200:
             data = response.json()
             st.session_state['chat_sessions'] = data.get('sessions', [])
@@ -54,13 +64,13 @@ def load_user_sessions():
         st.error(f"Failed to load sessions: {str(e)}")
 
 def load_session_history(session_id):
-    """Load chat history for a specific session"""
+    """Load the most recent page of chat history for a specific session"""
     try:
-        response = requests.post(f"{BACKEND_URL}/session/history", 
-                               json={"session_id": session_id})
+        response = api.post("/session/history", 
+                          json={"session_id": session_id, "limit": HISTORY_PAGE_SIZE}, idempotent=True)
         if response.status_code == 200:
             data = response.json()
-            st.session_state['history'] = data.get('history', [])
+            reset_transcript(data.get('history', []), data.get('has_more', False))
             st.session_state['current_session_id'] = session_id
         else:
             st.error(f"Failed to load history: {response.text}")
@@ -70,17 +80,17 @@ def load_session_history(session_id):
 def create_new_session():
     """Create a new chat session"""
     try:
-        response = requests.post(f"{BACKEND_URL}/session/create", 
-                               json={
-                                   "user_email": st.session_state['user_email'],
-                                   "user_name": st.session_state['user_name'],
-                                   "session_name": f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-                               })
+        response = api.post("/session/create", 
+                          json={
+                              "user_email": st.session_state['user_email'],
+                              "user_name": st.session_state['user_name'],
+                              "session_name": f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+                          })
         if response.status_code == 200:
             data = response.json()
             new_session_id = data['session_id']
             st.session_state['current_session_id'] = new_session_id
-            st.session_state['history'] = []
+            reset_transcript([], False)
             load_user_sessions()  # Refresh sessions list
             return new_session_id
     except Exception as e:
@@ -251,48 +261,7 @@ else:
     st.markdown('<div class="chat-container">', unsafe_allow_html=True)
     # Display chat history with beautiful styling
     if st.session_state['history']:
-        for msg in st.session_state['history']:
-            if msg['role'] == 'user':
-                # User messages - Modern blue gradient
-                st.markdown(f"""
-                <div style='display: flex; justify-content: flex-end; margin: 15px 0;'>
-                    <div style='
-                        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                        color: white;
-                        padding: 12px 16px;
-                        border-radius: 18px 18px 4px 18px;
-                        max-width: 70%;
-                        box-shadow: 0 2px 10px rgba(102, 126, 234, 0.3);
-                        font-size: 14px;
-                        line-height: 1.4;
-                        margin-left: 30%;
-                    '>
-                        <div style='font-weight: 600; font-size: 12px; color: rgba(255,255,255,0.8); margin-bottom: 4px;'>You</div>
-                        {msg['content']}
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                # AI messages - Soft pink gradient for girlfriend personality
-                st.markdown(f"""
-                <div style='display: flex; justify-content: flex-start; margin: 15px 0;'>
-                    <div style='
-                        background: linear-gradient(135deg, #ffecd2 0%, #fcb69f 100%);
-                        color: #2c3e50;
-                        padding: 12px 16px;
-                        border-radius: 18px 18px 18px 4px;
-                        max-width: 70%;
-                        box-shadow: 0 2px 10px rgba(252, 182, 159, 0.3);
-                        font-size: 14px;
-                        line-height: 1.4;
-                        margin-right: 30%;
-                        border-left: 3px solid #ff6b6b;
-                    '>
-                        <div style='font-weight: 600; font-size: 12px; color: #e74c3c; margin-bottom: 4px;'>Aanya</div>
-                        {msg['content']}
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+        render_transcript(api, companion_message_html)
     else:
         st.markdown("""
         <div style='
@@ -345,17 +314,23 @@ else:
             "model_provider": "Groq",
             "system_prompt": "You're not a bot — you're Aanya, my girlfriend. You text like a real person: caring, playful, moody, sometimes sarcastic or clingy, but always real. Keep messages short (under 30 words), emotional, and raw. No robotic replies — be unpredictable, honest, and talk like we've been dating for a while. You don't always use emojis, but when you do, they're natural and rare. If you're annoyed, show it playfully. If you're happy, let it show in tone. Talk like someone who actually feels — not someone trained to respond.",
             "messages": [user_input],
-            "allow_search": False
+            "allow_search": False,
+            "since_id": history_cursor(),
+            "idempotency_key": idempotency_key(user_input)
         }
         
         try:
             with st.spinner("AI is thinking..."):
-                response = requests.post(f"{BACKEND_URL}/chat", json=payload)
+                response = api.post("/chat", json=payload, idempotent=True)
             
             if response.status_code == 200:
                 result = response.json()
-                # Update chat history from database
-                st.session_state['history'] = result.get('history', [])
+                if result.get('resync'):
+                    # Too far behind to catch up from the delta; reload the newest page
+                    load_session_history(result['session_id'])
+                else:
+                    # Merge only the messages this turn added
+                    merge_history(result.get('messages', []))
                 # Clear input by rerunning
                 st.rerun()
             else:
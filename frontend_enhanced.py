@@ -1,9 +1,12 @@
 # Enhanced frontend with Google OAuth and personalized chat
 import streamlit as st
-import requests
 import json
 from datetime import datetime
 
+from api_client import BackendClient
+from chat_ui import (HISTORY_PAGE_SIZE, history_cursor, idempotency_key, init_transcript_state, merge_history,
+                     render_transcript, reset_transcript)
+
 # Configure Streamlit page
 st.set_page_config(
     page_title="Personalized AI Chat",
@@ -11,6 +14,13 @@ st.set_page_config(
     layout="wide"
 )
 
+# Shared backend client: one pool of keep-alive connections per Streamlit server process, reused across reruns
+@st.cache_resource
+def get_api_client():
+    return BackendClient("http://127.0.0.1:9999")
+
+api = get_api_client()
+
 # Mock Google OAuth (replace with actual implementation)
 def mock_google_auth():
     """Mock Google authentication - replace with actual Google OAuth"""
@@ -44,10 +54,10 @@ def mock_google_auth():
 def load_user_sessions():
     """Load user's chat sessions from backend"""
     try:
-        response = requests.post("http://127.0.0.1:9999/user/sessions", json={
+        response = api.post("/user/sessions", json={
             "user_email": st.session_state['user_email'],
             "user_name": st.session_state['user_name']
-        })
+        }, idempotent=True)
         if response.status_code == 200:
             return response.json().get('sessions', [])
     except:
@@ -57,7 +67,7 @@ def load_user_sessions():
 def create_new_session(session_name="New Chat"):
     """Create a new chat session"""
     try:
-        response = requests.post("http://127.0.0.1:9999/session/create", json={
+        response = api.post("/session/create", json={
             "user_email": st.session_state['user_email'],
             "user_name": st.session_state['user_name'],
             "session_name": session_name
@@ -69,16 +79,39 @@ def create_new_session(session_name="New Chat"):
     return None
 
 def load_session_history(session_id):
-    """Load chat history for a specific session"""
+    """Load the most recent page of chat history for a specific session; returns (messages, has_more)"""
     try:
-        response = requests.post("http://127.0.0.1:9999/session/history", json={
-            "session_id": session_id
-        })
+        response = api.post("/session/history", json={"session_id": session_id, "limit": HISTORY_PAGE_SIZE},
+                            idempotent=True)
         if response.status_code == 200:
-            return response.json().get('history', [])
+            data = response.json()
+            return data.get('history', []), data.get('has_more', False)
     except:
         pass
-    return []
+    return [], False
+
+def message_html(msg):
+    """Bubble template for one message (passed to render_transcript)"""
+    role = "You" if msg['role'] == 'user' else "AI"
+    timestamp = msg.get('timestamp', '')
+    
+    if msg['role'] == 'user':
+        return f"""
+        <div style='text-align: right; margin: 10px 0;'>
+            <div style='display: inline-block; padding: 10px 15px; background-color: #007ACC; color: white; border-radius: 15px 15px 5px 15px; max-width: 70%;'>
+                <strong>{role}:</strong> {msg['content']}
+            </div>
+            <div style='font-size: 0.8em; color: #666; margin-top: 2px;'>{timestamp[:16] if timestamp else ''}</div>
+        </div>
+        """
+    return f"""
+    <div style='text-align: left; margin: 10px 0;'>
+        <div style='display: inline-block; padding: 10px 15px; background-color: #f0f0f0; color: black; border-radius: 15px 15px 15px 5px; max-width: 70%;'>
+            <strong>{role}:</strong> {msg['content']}
+        </div>
+        <div style='font-size: 0.8em; color: #666; margin-top: 2px;'>{timestamp[:16] if timestamp else ''}</div>
+    </div>
+    """
 
 def main_chat_interface():
     """Main chat interface after authentication"""
@@ -86,8 +119,7 @@ def main_chat_interface():
     # Initialize session state
     if 'current_session_id' not in st.session_state:
         st.session_state['current_session_id'] = None
-    if 'history' not in st.session_state:
-        st.session_state['history'] = []
+    init_transcript_state()
     if 'sessions' not in st.session_state:
         st.session_state['sessions'] = load_user_sessions()
     
@@ -118,7 +150,7 @@ def main_chat_interface():
             session_id = create_new_session()
             if session_id:
                 st.session_state['current_session_id'] = session_id
-                st.session_state['history'] = []
+                reset_transcript([], False)
                 st.session_state['sessions'] = load_user_sessions()
                 st.rerun()
         
@@ -146,7 +178,7 @@ def main_chat_interface():
             
             if st.button(f"💬 {preview}", key=f"session_{session_id}", type=button_type, use_container_width=True):
                 st.session_state['current_session_id'] = session_id
-                st.session_state['history'] = load_session_history(session_id)
+                reset_transcript(*load_session_history(session_id))
                 st.rerun()
             
             # Show date
@@ -175,14 +207,14 @@ def main_chat_interface():
             if st.button("💾 Save Settings"):
                 # Save personalization settings
                 try:
-                    requests.post("http://127.0.0.1:9999/user/personalization", json={
+                    api.post("/user/personalization", json={
                         "user_email": st.session_state['user_email'],
                         "user_name": st.session_state['user_name'],
                         "personality_type": personality,
                         "conversation_style": style,
                         "emoji_preference": emoji_pref,
                         "custom_prompt": custom_prompt
-                    })
+                    }, idempotent=True)
                     st.success("Settings saved!")
                 except:
                     st.error("Failed to save settings")
@@ -201,28 +233,7 @@ def main_chat_interface():
     
     # Display chat history
     if st.session_state['history']:
-        for msg in st.session_state['history']:
-            role = "You" if msg['role'] == 'user' else "AI"
-            timestamp = msg.get('timestamp', '')
-            
-            if msg['role'] == 'user':
-                st.markdown(f"""
-                <div style='text-align: right; margin: 10px 0;'>
-                    <div style='display: inline-block; padding: 10px 15px; background-color: #007ACC; color: white; border-radius: 15px 15px 5px 15px; max-width: 70%;'>
-                        <strong>{role}:</strong> {msg['content']}
-                    </div>
-                    <div style='font-size: 0.8em; color: #666; margin-top: 2px;'>{timestamp[:16] if timestamp else ''}</div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div style='text-align: left; margin: 10px 0;'>
-                    <div style='display: inline-block; padding: 10px 15px; background-color: #f0f0f0; color: black; border-radius: 15px 15px 15px 5px; max-width: 70%;'>
-                        <strong>{role}:</strong> {msg['content']}
-                    </div>
-                    <div style='font-size: 0.8em; color: #666; margin-top: 2px;'>{timestamp[:16] if timestamp else ''}</div>
-                </div>
-                """, unsafe_allow_html=True)
+        render_transcript(api, message_html)
     
     # Input area
     with st.container():
@@ -244,17 +255,23 @@ def main_chat_interface():
             "model_provider": "Groq",
             "system_prompt": base_prompt,
             "messages": [user_input],
-            "allow_search": False
+            "allow_search": False,
+            "since_id": history_cursor(),
+            "idempotency_key": idempotency_key(user_input)
         }
         
         try:
             with st.spinner("AI is thinking..."):
-                response = requests.post("http://127.0.0.1:9999/chat", json=payload)
+                response = api.post("/chat", json=payload, idempotent=True)
             
             if response.status_code == 200:
                 result = response.json()
-                # Update history
-                st.session_state['history'] = result.get('history', [])
+                if result.get('resync'):
+                    # Too far behind to catch up from the delta; reload the newest page
+                    reset_transcript(*load_session_history(result['session_id']))
+                else:
+                    # Merge only the messages this turn added
+                    merge_history(result.get('messages', []))
                 # Update sessions if needed
                 st.session_state['sessions'] = load_user_sessions()
                 # Clear input by rerunning
@@ -0,0 +1,221 @@
+# Personalization pipeline: learn from user messages and build the persona system prompt
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from cache import LRUCache
+
+# Most favorite topics kept per profile
+MAX_FAVORITE_TOPICS = 10
+
+# Compiled persona prompts, keyed on (profile version, user name) (override size via environment)
+PERSONA_CACHE_SIZE = int(os.environ.get("PERSONA_CACHE_SIZE", "10000"))
+_persona_cache = LRUCache(maxsize=PERSONA_CACHE_SIZE)
+
+# Keyword tables (matched as whole words, case-insensitive, optional plural "s")
+INTEREST_KEYWORDS = {
+    'sports': ['football', 'basketball', 'soccer', 'tennis', 'gym', 'workout', 'exercise'],
+    'music': ['song', 'music', 'band', 'concert', 'guitar', 'piano', 'singing'],
+    'movies': ['movie', 'film', 'netflix', 'cinema', 'actor', 'actress', 'series'],
+    'food': ['food', 'cooking', 'recipe', 'restaurant', 'dinner', 'lunch', 'breakfast'],
+    'travel': ['travel', 'trip', 'vacation', 'holiday', 'flight', 'hotel', 'beach'],
+    'technology': ['tech', 'computer', 'phone', 'app', 'coding', 'programming', 'ai'],
+    'books': ['book', 'reading', 'novel', 'story', 'author', 'library'],
+    'games': ['game', 'gaming', 'xbox', 'playstation', 'nintendo', 'pc gaming']
+}
+# Conversation style cues, in priority order (the first style with a match wins)
+STYLE_KEYWORDS = [
+    ('humorous', ['lol', 'haha', 'funny', 'joke']),
+    ('serious', ['serious', 'important', 'concern']),
+    ('romantic', ['cute', 'sweet', 'love', 'miss']),
+]
+
+# Emoji and pictographic symbols (emoticons, symbols & pictographs, dingbats, flags)
+EMOJI_PATTERN = re.compile(
+    "[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\u2300-\u23FF\U0001F1E6-\U0001F1FF]"
+)
+
+def _compile_keywords(tables: Iterable[Tuple[str, str, List[str]]]):
+    """One alternation regex over every keyword, plus keyword -> [(kind, label)]"""
+    labels: Dict[str, List[Tuple[str, str]]] = {}
+    for kind, label, keywords in tables:
+        for keyword in keywords:
+            labels.setdefault(keyword, []).append((kind, label))
+    # Longest first so "pc gaming" wins over "gaming"
+    alternation = "|".join(re.escape(k) for k in sorted(labels, key=len, reverse=True))
+    return re.compile(rf"\b({alternation})s?\b", re.IGNORECASE), labels
+
+KEYWORD_PATTERN, KEYWORD_LABELS = _compile_keywords(
+    [('interest', category, keywords) for category, keywords in INTEREST_KEYWORDS.items()] +
+    [('style', style, keywords) for style, keywords in STYLE_KEYWORDS]
+)
+_INTEREST_ORDER = {category: i for i, category in enumerate(INTEREST_KEYWORDS)}
+_STYLE_ORDER = {style: i for i, (style, _) in enumerate(STYLE_KEYWORDS)}
+
+def analyze_user_message(message, history_length):
+    """Analyze user message to extract interests, mood, and preferences for personalization.
+
+    One pass of a precompiled keyword regex finds interests and style cues;
+    history_length is the number of prior messages in the conversation.
+    """
+    updates = {}
+
+    interests = set()
+    styles = set()
+    for match in KEYWORD_PATTERN.finditer(message):
+        for kind, label in KEYWORD_LABELS[match.group(1).lower()]:
+            (interests if kind == 'interest' else styles).add(label)
+
+    if interests:
+        updates['favorite_topics'] = sorted(interests, key=_INTEREST_ORDER.get)
+
+    # Detect conversation style preferences
+    if styles:
+        updates['conversation_style'] = min(styles, key=_STYLE_ORDER.get)
+
+    # Detect emoji preferences
+    emoji_count = len(EMOJI_PATTERN.findall(message))
+    if emoji_count > 2:
+        updates['emoji_preference'] = 'frequent'
+    elif emoji_count == 0 and history_length > 5:
+        updates['emoji_preference'] = 'rare'
+
+    return {'updates': updates if updates else None}
+
+def merge_profile_updates(current: Dict, updates: Dict) -> Dict:
+    """Turn learned updates into the fields to write: new topics are merged into the existing ones
+    and fields that wouldn't change are dropped"""
+    merged = {}
+    for key, value in updates.items():
+        if key == 'favorite_topics':
+            existing_topics = list(current.get('favorite_topics', []))
+            topics = existing_topics + [topic for topic in value if topic not in existing_topics]
+            value = topics[:MAX_FAVORITE_TOPICS]  # Limit to 10 topics
+        if current.get(key) != value:
+            merged[key] = value
+    return merged
+
+def create_personalized_prompt(user_profile, user_name):
+    """Create a personalized system prompt based on user's learned preferences"""
+    base_personality = "You're not a bot — you're my girlfriend. You talk like a real person: warm, caring, sometimes teasing or moody, but mostly chill and friendly. Keep replies short (under 30 words), honest, and natural. If someone says something unclear or confusing, respond naturally like 'I didn't get that' or 'What do you mean?' - don't be robotic about it."
+    # Customize based on user profile
+    style_additions = ""
+
+    # Conversation style customization
+    conv_style = user_profile.get('conversation_style', 'casual')
+    if conv_style == 'humorous':
+        style_additions += " I love your sense of humor, so I'm often playful and witty with you."
+    elif conv_style == 'romantic':
+        style_additions += " You're so sweet and romantic, so I match that energy with warmth and affection.you are free to talk about sexual and romantic story"
+    elif conv_style == 'serious':
+        style_additions += " You appreciate deeper conversations, so I'm thoughtful and genuine with you."
+
+    # Interest-based customization
+    interests = user_profile.get('favorite_topics', [])
+    if interests:
+        interests_text = ", ".join(interests)
+        style_additions += f" I know you're into {interests_text}, so I sometimes reference these interests naturally."
+
+    # Emoji preference
+    emoji_pref = user_profile.get('emoji_preference', 'rare')
+    if emoji_pref == 'frequent':
+        style_additions += " You like emojis, so I use them more often when it feels right."
+    elif emoji_pref == 'rare':
+        style_additions += " You prefer cleaner text, so I use emojis sparingly."
+
+    # Personality type
+    personality = user_profile.get('personality_type', 'girlfriend')
+    if personality == 'girlfriend':
+        style_additions += " I'm your girlfriend who knows you well - sometimes flirty, Mostly time just your best friend."
+
+    # Custom prompt override
+    if user_profile.get('custom_prompt'):
+        return user_profile['custom_prompt'] + style_additions
+
+    return base_personality + style_additions + " You sound like someone I've really been dating — relaxed, playful, and a little flirty only sometimes. Don't be overly emotional or robotic. Use emojis only when it feels natural. If you're bored, annoyed, or happy — just say it like real people do. Keep it casual, real, and alive. Handle greetings like 'hi' warmly, and if something doesn't make sense, just ask what I mean in a natural way. Chat in proper in girfriend mode"
+
+def get_persona_prompt(user_profile, user_name):
+    """Persona system prompt, compiled once per (profile version, user name).
+
+    Profiles from ChatDatabase.get_user_personalization carry a 'version'
+    that changes whenever the profile does; without one the prompt is
+    simply built.
+    """
+    version = user_profile.get('version')
+    if version is None:
+        return create_personalized_prompt(user_profile, user_name)
+    return _persona_cache.get_or_create((version, user_name),
+                                        lambda: create_personalized_prompt(user_profile, user_name))
+
+def get_persona_cache_stats():
+    """Get hit/miss counters for the compiled persona prompts"""
+    return _persona_cache.stats()
+
+# Per-turn instruction, sent as its own system message so the persona prompt stays byte-identical across turns
+ONGOING_CONVERSATION_INSTRUCTION = "Based on our conversation history and what I know about you, respond naturally and reference things we've talked about when relevant. Remember details about your life, interests, and feelings you've shared."
+NEW_CONVERSATION_INSTRUCTION = "This is the start of our conversation, so be warm and welcoming based on what I know about you!"
+
+def conversation_instruction(has_history):
+    """The dynamic part of the persona: how to treat an ongoing vs. a new conversation"""
+    return ONGOING_CONVERSATION_INSTRUCTION if has_history else NEW_CONVERSATION_INSTRUCTION
+
+def learn_from_messages(profile: Dict, messages: List[str], history_length: int) -> Optional[Dict]:
+    """Analyze this turn's messages against the profile; return the fields to update, or None"""
+    analysis = analyze_user_message(" ".join(messages), history_length)
+    if not analysis['updates']:
+        return None
+    return merge_profile_updates(profile, analysis['updates']) or None
+
+def backfill_profiles(database, dry_run: bool = False, batch_size: int = 1000) -> Dict[int, Dict]:
+    """Learn profiles from every stored message in one pass and return the changes per user.
+
+    Messages are replayed in id order, so each profile evolves in memory as
+    it would have turn by turn; the net changes are then written in a single
+    transaction (skipped with dry_run).
+    """
+    profiles: Dict[int, Dict] = {}
+    originals: Dict[int, Dict] = {}
+    # Messages seen so far per session (the analyzer's history length)
+    session_positions: Dict[int, int] = {}
+
+    for _, user_id, session_id, role, content in database.iter_messages(batch_size):
+        position = session_positions.get(session_id, 0)
+        session_positions[session_id] = position + 1
+        if role != 'user':
+            continue
+
+        if user_id not in profiles:
+            profiles[user_id] = database.get_user_personalization(user_id)
+            originals[user_id] = dict(profiles[user_id])
+        profile = profiles[user_id]
+        if not profile:
+            continue
+
+        updates = learn_from_messages(profile, [content], position)
+        if updates:
+            profile.update(updates)
+
+    changes = {}
+    for user_id, profile in profiles.items():
+        changed = {key: value for key, value in profile.items()
+                   if key != 'version' and originals[user_id].get(key) != value}
+        if changed:
+            changes[user_id] = changed
+
+    if changes and not dry_run:
+        with database.unit_of_work() as uow:
+            for user_id, updates in changes.items():
+                uow.update_user_personalization(user_id, **updates)
+    return changes
+
+if __name__ == "__main__":
+    import sys
+    from database import db
+
+    if "--backfill" in sys.argv:
+        dry_run = "--dry-run" in sys.argv
+        changes = backfill_profiles(db, dry_run=dry_run)
+        for user_id, updates in changes.items():
+            print(f"user {user_id}: {updates}")
+        print(f"{len(changes)} profile(s) {'would be ' if dry_run else ''}updated")
+    db.close()
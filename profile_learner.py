@@ -0,0 +1,146 @@
+# Background personalization learning, kept off the chat request path
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, List
+
+from database import db, ChatDatabase
+from personalization import learn_from_messages, merge_profile_updates
+
+logger = logging.getLogger(__name__)
+
+# Learning settings (override via environment). Events are collected for up to
+# LEARNING_FLUSH_INTERVAL seconds (or LEARNING_MAX_BATCH events), merged per
+# user and written in one transaction.
+LEARNING_FLUSH_INTERVAL = float(os.environ.get("LEARNING_FLUSH_INTERVAL", "2"))
+LEARNING_MAX_BATCH = int(os.environ.get("LEARNING_MAX_BATCH", "500"))
+LEARNING_QUEUE_SIZE = int(os.environ.get("LEARNING_QUEUE_SIZE", "10000"))
+
+
+class ProfileLearner:
+    """Dedicated thread that applies queued learning events to personalization profiles in batches"""
+
+    def __init__(self, database: ChatDatabase, flush_interval: float = LEARNING_FLUSH_INTERVAL,
+                 max_batch: int = LEARNING_MAX_BATCH, queue_size: int = LEARNING_QUEUE_SIZE):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.max_batch = max(1, max_batch)
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        # Counters reported by stats()
+        self.events = 0
+        self.dropped = 0
+        self.batches = 0
+        self.profiles_written = 0
+        self.failures = 0
+
+        # Set by close() when the queue is too full to take the stop marker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-learner", daemon=True)
+        self._thread.start()
+
+    def _submit(self, event):
+        try:
+            self._queue.put_nowait(event)
+            self.events += 1
+        except queue.Full:
+            # Learning is best-effort; never make a chat turn wait for it
+            self.dropped += 1
+
+    def submit_messages(self, user_id: int, messages: List[str], history_length: int):
+        """Queue this turn's user messages for analysis"""
+        self._submit((user_id, 'messages', messages, history_length))
+
+    def submit_updates(self, user_id: int, updates: Dict):
+        """Queue already-analyzed profile updates (merged like /user/personalization/update)"""
+        self._submit((user_id, 'updates', updates, 0))
+
+    def _run(self):
+        stopping = False
+        while not stopping and not self._stop.is_set():
+            try:
+                event = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if event is None:
+                break
+            batch = [event]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop.is_set():
+                    break
+                try:
+                    event = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+
+            try:
+                self.apply(batch)
+            except Exception:
+                # These events are lost; later turns will teach the same things again
+                self.failures += 1
+                logger.exception("Applying %d learning events failed", len(batch))
+
+    def apply(self, batch: List) -> Dict[int, Dict]:
+        """Merge a batch of events per user and write the changed profiles in one transaction.
+
+        Profiles are read inside the write transaction, so learned topics are
+        merged into what is stored now rather than into a cached copy that a
+        concurrent settings update may have made stale.
+        """
+        profiles: Dict[int, Dict] = {}
+        changes: Dict[int, Dict] = {}
+        with self.db.unit_of_work() as uow:
+            for user_id, kind, payload, history_length in batch:
+                if user_id not in profiles:
+                    profiles[user_id] = uow.get_user_personalization(user_id)
+                profile = profiles[user_id]
+                if not profile:
+                    continue
+
+                if kind == 'messages':
+                    updates = learn_from_messages(profile, payload, history_length)
+                else:
+                    updates = merge_profile_updates(profile, payload)
+                if updates:
+                    profile.update(updates)
+                    changes.setdefault(user_id, {}).update(updates)
+
+            for user_id, updates in changes.items():
+                uow.update_user_personalization(user_id, **updates)
+        self.batches += 1
+        self.profiles_written += len(changes)
+        return changes
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self._queue.qsize(),
+            'events': self.events,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'profiles_written': self.profiles_written,
+            'failures': self.failures
+        }
+
+    def close(self, timeout: float = 10.0):
+        """Apply everything already queued, then stop the thread (call on application shutdown).
+
+        If the queue is full, the thread stops after its current batch instead
+        and the rest is dropped, so shutdown never waits on a backlog.
+        """
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            self._stop.set()
+        self._thread.join(timeout)
+
+
+# Global learner instance
+learner = ProfileLearner(db)
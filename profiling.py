@@ -0,0 +1,175 @@
+# Opt-in request tracing: span timelines, sampled CPU profiles and a slow-request log
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Profiling settings (override via environment). A request is traced when it
+# is picked by PROFILE_SAMPLE_RATE (spans are cheap, so a rate of 1.0 is a
+# reasonable way to catch every slow request) or sends an X-Profile header
+# ("1" for spans, "cpu" to add a CPU profile) together with an
+# X-Profile-Token matching PROFILE_TOKEN; without a PROFILE_TOKEN the header
+# is ignored. Traced requests slower than SLOW_REQUEST_THRESHOLD seconds, and
+# all X-Profile requests, are written to SLOW_REQUEST_LOG as one JSON object
+# per line.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_SAMPLED_CPU = os.environ.get("PROFILE_SAMPLED_CPU", "false").lower() in ("1", "true", "yes")
+PROFILE_CPU_INTERVAL = float(os.environ.get("PROFILE_CPU_INTERVAL", "0.005"))
+PROFILE_CPU_TOP_STACKS = int(os.environ.get("PROFILE_CPU_TOP_STACKS", "20"))
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", "10"))
+SLOW_REQUEST_LOG = os.environ.get("SLOW_REQUEST_LOG", "slow_requests.log")
+SLOW_REQUEST_LOG_MAX_BYTES = int(os.environ.get("SLOW_REQUEST_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SLOW_REQUEST_LOG_BACKUPS = int(os.environ.get("SLOW_REQUEST_LOG_BACKUPS", "5"))
+
+# Most frames kept per sampled stack
+MAX_STACK_DEPTH = 64
+
+_current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("current_trace", default=None)
+
+
+class CpuSampler:
+    """Statistical profiler: samples one thread's Python stack every interval from a helper thread.
+
+    Requests are served on the event loop thread, so the samples also
+    include whatever else the loop ran meanwhile.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_CPU_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cpu-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            # Collapsed format, outermost frame first
+            self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, top: int = PROFILE_CPU_TOP_STACKS) -> Dict:
+        """Stop sampling and return the most frequent stacks"""
+        self._stop.set()
+        self._thread.join()
+        return {
+            'interval_seconds': self.interval,
+            'samples': self.samples,
+            'stacks': [{'stack': stack, 'samples': count} for stack, count in self._stacks.most_common(top)]
+        }
+
+
+class RequestTrace:
+    """Span timeline of one request, collected through a context variable"""
+
+    def __init__(self, method: str, path: str, cpu: bool = False, forced: bool = False):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.forced = forced
+        self.started = time.perf_counter()
+        self.spans: List[Dict] = []
+        self._sampler = CpuSampler(threading.get_ident()) if cpu else None
+        if self._sampler:
+            self._sampler.start()
+
+    def add_span(self, name: str, started: float, ended: float, attrs: Dict):
+        span = {'name': name, 'start_ms': round((started - self.started) * 1000, 3),
+                'duration_ms': round((ended - started) * 1000, 3)}
+        attrs = {key: value for key, value in attrs.items() if value is not None}
+        if attrs:
+            span['attrs'] = attrs
+        self.spans.append(span)
+
+    def server_timing(self) -> str:
+        """Total time per span name as a Server-Timing header value"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span['name']] = totals.get(span['name'], 0.0) + span['duration_ms']
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in totals.items())
+
+    def finish(self, status: int) -> Dict:
+        duration = time.perf_counter() - self.started
+        record = {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'duration_ms': round(duration * 1000, 3),
+            'spans': sorted(self.spans, key=lambda span: span['start_ms'])
+        }
+        if self._sampler:
+            record['cpu_profile'] = self._sampler.stop()
+        if self.forced or duration >= SLOW_REQUEST_THRESHOLD:
+            _write_slow_request(record)
+        return record
+
+
+_slow_log: Optional[logging.Logger] = None
+_slow_log_lock = threading.Lock()
+
+
+def _write_slow_request(record: Dict):
+    global _slow_log
+    if _slow_log is None:
+        with _slow_log_lock:
+            if _slow_log is None:
+                handler = RotatingFileHandler(SLOW_REQUEST_LOG, maxBytes=SLOW_REQUEST_LOG_MAX_BYTES,
+                                              backupCount=SLOW_REQUEST_LOG_BACKUPS, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                slow_log = logging.getLogger(f"{__name__}.slow_requests")
+                slow_log.addHandler(handler)
+                slow_log.setLevel(logging.INFO)
+                slow_log.propagate = False
+                _slow_log = slow_log
+    _slow_log.info(json.dumps(record, default=str))
+
+
+def _profiling_authorized(profile_token: Optional[str]) -> bool:
+    return bool(PROFILE_TOKEN) and hmac.compare_digest((profile_token or "").encode(), PROFILE_TOKEN.encode())
+
+
+def start_trace(method: str, path: str, profile_header: Optional[str] = None,
+                profile_token: Optional[str] = None) -> Optional[RequestTrace]:
+    """Start tracing the current request if it asked to be profiled (with the right token) or was sampled;
+    returns None otherwise"""
+    requested = (profile_header and profile_header.lower() not in ("0", "false", "no")
+                 and _profiling_authorized(profile_token))
+    if requested:
+        trace = RequestTrace(method, path, cpu=profile_header.lower() == "cpu", forced=True)
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        trace = RequestTrace(method, path, cpu=PROFILE_SAMPLED_CPU)
+    else:
+        return None
+    _current_trace.set(trace)
+    return trace
+
+
+def record_span(name: str, started: float, ended: Optional[float] = None, **attrs):
+    """Add an already-timed span (perf_counter values) to the current request's trace, if any"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, time.perf_counter() if ended is None else ended, attrs)
@@ -0,0 +1,150 @@
+# Rolling per-session conversation summaries, built in the background
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from ai_agent import get_response_from_ai_agent
+from cache import LRUCache
+from context_builder import CONTEXT_HISTORY_LIMIT, estimate_tokens
+from database import db, ChatDatabase
+
+logger = logging.getLogger(__name__)
+
+# Summarization settings (override via environment). Once a session's
+# unsummarized messages exceed SUMMARY_TRIGGER_TOKENS, everything but the
+# newest SUMMARY_KEEP_RECENT messages is folded into the stored summary.
+# Summaries use the model and provider of the turn that triggered them
+# unless SUMMARY_MODEL and SUMMARY_PROVIDER are set. A session whose summary
+# failed isn't retried for SUMMARY_RETRY_BACKOFF seconds, doubling with each
+# further failure up to SUMMARY_RETRY_BACKOFF_MAX.
+SUMMARY_ENABLED = os.environ.get("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", "2000"))
+SUMMARY_KEEP_RECENT = int(os.environ.get("SUMMARY_KEEP_RECENT", "10"))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "")
+SUMMARY_PROVIDER = os.environ.get("SUMMARY_PROVIDER", "")
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "1"))
+SUMMARY_RETRY_BACKOFF = float(os.environ.get("SUMMARY_RETRY_BACKOFF", "60"))
+SUMMARY_RETRY_BACKOFF_MAX = float(os.environ.get("SUMMARY_RETRY_BACKOFF_MAX", "3600"))
+
+# Most sessions whose failure backoff is remembered
+MAX_BACKOFF_SESSIONS = 10000
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a chat between a user and an AI companion. "
+    "Merge the new messages into the existing summary. Keep names, facts the user shared, "
+    "preferences, plans and the emotional tone; drop small talk. "
+    "Reply with the updated summary only, in under 200 words."
+)
+
+
+def _format_transcript(messages: List[Dict]) -> str:
+    return "\n".join(f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in messages)
+
+
+def _summarize(previous_summary: Optional[str], messages: List[Dict], model_name: str, provider: str) -> str:
+    """Ask the summary model to fold messages into the previous summary"""
+    prompt = (
+        f"Existing summary:\n{previous_summary or '(none yet)'}\n\n"
+        f"New messages:\n{_format_transcript(messages)}"
+    )
+    return get_response_from_ai_agent(model_name, [prompt], False, SUMMARY_SYSTEM_PROMPT,
+                                      provider, use_cache=False).strip()
+
+
+def unsummarized_tokens(history: List[Dict], summary_through_id: int, new_messages: List[str]) -> int:
+    """Estimated tokens not yet covered by the summary, including this turn's new messages"""
+    stored = sum(m['tokens'] for m in history if m['id'] > summary_through_id)
+    return stored + sum(estimate_tokens(content) for content in new_messages)
+
+
+class SessionSummarizer:
+    """Runs summary updates on a small thread pool, at most one per session at a time"""
+
+    def __init__(self, database: ChatDatabase, trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+                 keep_recent: int = SUMMARY_KEEP_RECENT, workers: int = SUMMARY_WORKERS,
+                 retry_backoff: float = SUMMARY_RETRY_BACKOFF, retry_backoff_max: float = SUMMARY_RETRY_BACKOFF_MAX):
+        self.db = database
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent = keep_recent
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="summarizer")
+        self._in_flight = set()
+        # session_id -> (consecutive failures, monotonic time before which it isn't retried)
+        self._backoff = LRUCache(maxsize=MAX_BACKOFF_SESSIONS)
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+
+    def needs_summary(self, unsummarized_tokens: int) -> bool:
+        return SUMMARY_ENABLED and unsummarized_tokens >= self.trigger_tokens
+
+    def schedule(self, session_id: int, model_name: str, provider: str) -> bool:
+        """Queue a summary update (with the turn's model unless overridden) unless one is already
+        pending for the session or it is backing off after a failure"""
+        backoff = self._backoff.peek(session_id)
+        if backoff is not None and time.monotonic() < backoff[1]:
+            return False
+        with self._lock:
+            if session_id in self._in_flight:
+                return False
+            self._in_flight.add(session_id)
+        self._executor.submit(self._run, session_id, SUMMARY_MODEL or model_name, SUMMARY_PROVIDER or provider)
+        return True
+
+    def _run(self, session_id: int, model_name: str, provider: str):
+        try:
+            self.summarize_session(session_id, model_name, provider)
+            self._backoff.pop(session_id)
+        except Exception:
+            self.failures += 1
+            failures = self._backoff.peek(session_id, (0, 0))[0] + 1
+            delay = min(self.retry_backoff * 2 ** (failures - 1), self.retry_backoff_max)
+            self._backoff.set(session_id, (failures, time.monotonic() + delay))
+            logger.exception("Summarizing session %s failed (%d in a row); retrying in %.0fs at the earliest",
+                             session_id, failures, delay)
+        finally:
+            with self._lock:
+                self._in_flight.discard(session_id)
+
+    def summarize_session(self, session_id: int, model_name: str, provider: str) -> bool:
+        """Fold older unsummarized messages into the session summary; return True if it changed"""
+        with self.db.unit_of_work(write=False) as uow:
+            state = uow.get_session_summary(session_id)
+            history = uow.get_chat_history(session_id, limit=CONTEXT_HISTORY_LIMIT)
+
+        unsummarized = [m for m in history if m['id'] > state['summary_through_id']]
+        if sum(m['tokens'] for m in unsummarized) < self.trigger_tokens:
+            return False
+        to_fold = unsummarized[:-self.keep_recent] if self.keep_recent > 0 else unsummarized
+        if not to_fold:
+            return False
+
+        summary = _summarize(state['summary'], to_fold, model_name, provider)
+        self.runs += 1
+        # Compare-and-set on the old position, so a concurrent update is never overwritten
+        return self.db.update_session_summary(session_id, summary, to_fold[-1]['id'],
+                                               state['summary_through_id'])
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = len(self._in_flight)
+        return {
+            'enabled': SUMMARY_ENABLED,
+            'trigger_tokens': self.trigger_tokens,
+            'pending': pending,
+            'failing_sessions': len(self._backoff),
+            'runs': self.runs,
+            'failures': self.failures
+        }
+
+    def close(self):
+        """Let queued summaries finish (call on application shutdown)"""
+        self._executor.shutdown(wait=True)
+
+
+# Global summarizer instance
+summarizer = SessionSummarizer(db)
@@ -0,0 +1,116 @@
+# Unit tests for the in-process caches (run with pytest)
+import asyncio
+import time
+
+from cache import LRUCache, SingleFlight
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_lru_counts_hits_and_misses():
+    cache = LRUCache(maxsize=4)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("missing")
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+
+
+def test_lru_expires_entries():
+    cache = LRUCache(maxsize=4, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a", "gone") == "gone"
+    assert cache.expirations == 1
+
+
+def test_lru_peek_is_not_counted_and_keeps_recency():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.peek("a") == 1
+    assert cache.peek("missing", "default") == "default"
+    assert (cache.hits, cache.misses) == (0, 0)
+    # Peeking didn't make "a" recently used, so it is still evicted first
+    cache.set("c", 3)
+    assert "a" not in cache and "b" in cache
+
+
+def test_lru_get_or_create_builds_once():
+    cache = LRUCache(maxsize=4)
+    calls = []
+    for _ in range(3):
+        assert cache.get_or_create("a", lambda: calls.append(1) or "value") == "value"
+    assert len(calls) == 1
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*(flights.do("key", work) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["result"] * 5
+    assert len(calls) == 1
+    assert flights.stats() == {'in_flight': 0, 'calls': 1, 'coalesced': 4}
+
+
+def test_single_flight_runs_again_once_finished():
+    flights = SingleFlight()
+
+    async def work():
+        return "result"
+
+    async def main():
+        await flights.do("key", work)
+        assert not flights.running("key")
+        await flights.do("key", work)
+
+    asyncio.run(main())
+    assert flights.calls == 2 and flights.coalesced == 0
+
+
+def test_single_flight_survives_a_cancelled_caller():
+    flights = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        first = asyncio.ensure_future(flights.do("key", work))
+        second = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == "result"
+
+
+def test_single_flight_shares_exceptions():
+    flights = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def main():
+        return await asyncio.gather(flights.do("key", work), flights.do("key", work), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
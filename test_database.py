@@ -0,0 +1,75 @@
+# Unit tests for the personalization cache in ChatDatabase (run with pytest)
+import pytest
+
+from database import ChatDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = ChatDatabase(db_path=str(tmp_path / "chat.db"), compaction_interval=0, login_flush_interval=0)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def user_id(db):
+    return db.create_or_get_user("test@example.com", "Test User")
+
+
+def test_personalization_is_cached_after_first_read(db, user_id):
+    first = db.get_user_personalization(user_id)
+    second = db.get_user_personalization(user_id)
+    assert first == second
+    stats = db.get_cache_stats()['personalization']
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_update_writes_through_with_a_new_version(db, user_id):
+    before = db.get_user_personalization(user_id)
+    db.update_user_personalization(user_id, conversation_style="formal", favorite_topics=["chess"])
+    after = db.get_user_personalization(user_id)
+    assert after['conversation_style'] == "formal"
+    assert after['favorite_topics'] == ["chess"]
+    assert after['version'] != before['version']
+    # The merged profile was cached by the update, so the read above was a hit
+    stats = db.get_cache_stats()['personalization']
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_update_does_not_count_a_cache_lookup(db, user_id):
+    db.update_user_personalization(user_id, conversation_style="formal")
+    stats = db.get_cache_stats()['personalization']
+    assert (stats['hits'], stats['misses']) == (0, 0)
+
+
+def test_read_that_raced_with_a_write_is_not_cached(db, user_id):
+    with db._personalization_read(user_id) as generation:
+        # A write commits after this read started...
+        db.update_user_personalization(user_id, conversation_style="formal")
+        # ...so the profile it read (before the write) must not be cached
+        db._cache_personalization(user_id, generation, (0, {'conversation_style': "casual"}))
+    assert db.get_user_personalization(user_id)['conversation_style'] == "formal"
+
+
+def test_read_without_a_racing_write_is_cached(db, user_id):
+    with db._personalization_read(user_id) as generation:
+        db._cache_personalization(user_id, generation, (0, {'conversation_style': "casual",
+                                                            'favorite_topics': []}))
+    assert db.get_user_personalization(user_id)['version'] == 0
+
+
+def test_generations_are_dropped_once_no_read_is_in_flight(db, user_id):
+    db.get_user_personalization(user_id)
+    db.update_user_personalization(user_id, conversation_style="formal")
+    with db._personalization_read(user_id):
+        with db._personalization_read(user_id):
+            pass
+        assert user_id in db._personalization_generations
+    assert db._personalization_generations == {}
+
+
+def test_generation_is_dropped_when_the_read_fails(db, user_id):
+    with pytest.raises(RuntimeError):
+        with db._personalization_read(user_id):
+            raise RuntimeError("read failed")
+    assert db._personalization_generations == {}
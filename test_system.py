@@ -37,7 +37,7 @@ def test_backend():
         if chat_response.status_code == 200:
             chat_data = chat_response.json()
             print(f"✅ Chat response: {chat_data['response'][:50]}...")
-            print(f"✅ History length: {len(chat_data['history'])}")
+            print(f"✅ New messages this turn: {len(chat_data['messages'])} (cursor: {chat_data['cursor']})")
         else:
             print(f"❌ Chat failed: {chat_response.status_code}")
     else: